@@ -1,25 +1,140 @@
+import os
+import sys
+import re
 import json
+import hashlib
+import gzip
+import zlib
+import mimetypes
+import tempfile
 import time
-import requests
+import random
+import heapq
+import contextvars
 import datetime
+import importlib.util
 import urllib.parse
 from pathlib import Path 
 from typing import Union
 import asyncio 
+import jinja2
+from jinja2.bccache import FileSystemBytecodeCache
+from markupsafe import Markup
+import threading
+import bisect
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Response, Request, Cookie
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
-from fastapi.staticfiles import StaticFiles
 from starlette.concurrency import run_in_threadpool 
+from starlette.datastructures import Headers, MutableHeaders
+
+# 高速起動モード (サーバーレス環境向け)。重いモジュールの読み込みを初めて使うときまで遅らせる
+FAST_START = os.environ.get("FAST_START", "1" if os.environ.get("VERCEL") else "0") == "1"
+
+def lazyImport(name):
+    """モジュールを登録だけしておき、最初に属性を参照したときに読み込む"""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+if FAST_START:
+    httpx = lazyImport("httpx")
+else:
+    import httpx
+sqlite3 = lazyImport("sqlite3")  # SHARED_STORE_URL に sqlite を指定した場合だけ使う
+
+
+class TemplateBytecodeCache(FileSystemBytecodeCache):
+    """
+    ビルド時に作成したテンプレートのバイトコードを読み込む。読み取り専用の環境では書き込みに失敗しても無視する。
+    同期用と非同期用の環境ではコンパイル結果が異なるため、pattern でファイルを分ける。
+    """
+    def get_cache_key(self, name, filename=None):
+        # 絶対パスを含めず、ビルドした場所と実行する場所が異なっても (Vercel) 同じキーになるようにする
+        return super().get_cache_key(name)
+
+    def dump_bytecode(self, bucket):
+        try:
+            super().dump_bytecode(bucket)
+        except OSError:
+            pass
 
 BASE_DIR = Path(__file__).resolve().parent.parent
+# python -m app.precompile で作成する。Vercel にはビルド手順が無いため、Vercel のランタイムと同じ
+# Python で作成してコミットした VERCEL_TEMPLATE_CACHE_DIR を使う (バイトコードは Python のバージョンごとに異なる)。
+# テンプレートを変更したら python3.9 -m app.precompile --vercel --check で古くなっていないか確かめる
+VERCEL_TEMPLATE_CACHE_DIR = BASE_DIR / "vercel_template_cache"
+TEMPLATE_CACHE_DIR = Path(os.environ.get("TEMPLATE_CACHE_DIR", VERCEL_TEMPLATE_CACHE_DIR if os.environ.get("VERCEL") else BASE_DIR / ".jinja_cache"))
+
+def templateBytecodeCache(kind):
+    if not TEMPLATE_CACHE_DIR.is_dir():
+        return None
+    return TemplateBytecodeCache(str(TEMPLATE_CACHE_DIR), f"__jinja2_{kind}_%s.cache")
+
 templates = Jinja2Templates(directory=str(BASE_DIR / "templates")) 
+templates.env.bytecode_cache = templateBytecodeCache("sync")
+# ストリーミング描画用 (Jinjaの非同期生成)。フィルタとグローバルは templates と共有する
+stream_templates = jinja2.Environment(loader=templates.env.loader, autoescape=True, enable_async=True, bytecode_cache=templateBytecodeCache("async"))
+stream_templates.filters = templates.env.filters
+stream_templates.globals = templates.env.globals
+
+def precompileTemplates():
+    """すべてのテンプレートをコンパイルしてバイトコードキャッシュに書き出す (ビルド時に実行する)"""
+    TEMPLATE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    names = templates.env.list_templates(extensions=["html"])
+    for kind, env in (("sync", templates.env), ("async", stream_templates)):
+        env.bytecode_cache = templateBytecodeCache(kind)
+        env.cache.clear()
+        for name in names:
+            env.get_template(name)
+    return names
+
+def staleTemplateCaches():
+    """バイトコードキャッシュが無いか、テンプレートの変更後に作り直されていないものを (種類, テンプレート名) の一覧で返す"""
+    stale = []
+    for kind, env in (("sync", templates.env), ("async", stream_templates)):
+        cache = templateBytecodeCache(kind)
+        for name in templates.env.list_templates(extensions=["html"]):
+            source, filename, _ = env.loader.get_source(env, name)
+            # チェックサムか Python のバージョンが一致しないと、Jinja は何も言わずに code を None にして読み飛ばす
+            if cache is None or cache.get_bucket(env, name, filename, source).code is None:
+                stale.append((kind, name))
+    return stale
+STREAM_FLUSH = Markup("<!-- flush -->")  # テンプレート中の {{ stream_flush }} の位置でそれまでの出力を送信する
 
 class APITimeoutError(Exception): pass
 def getRandomUserAgent(): return {'User-Agent': 'Mozilla/50 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/94.0.4606.61 Safari/537.36'}
-def isJSON(json_str):
-    try: json.loads(json_str); return True
-    except json.JSONDecodeError: return False
+
+try:
+    import orjson  # 任意の依存パッケージ。インストールされていればJSONのデコードに使う
+except ImportError:
+    orjson = None
+try:
+    import brotli  # 任意の依存パッケージ。インストールされていれば Accept-Encoding: br に対応する
+except ImportError:
+    brotli = None
+
+def decodeJSON(data):
+    """
+    上流の応答 (bytes または str) をデコードする。res.text を経由せず、1つの応答につき1回だけ呼ぶ。
+    不正なJSONは ValueError (json.JSONDecodeError / orjson.JSONDecodeError) になる。
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def encodeJSON(value):
+    """共有ストアへ書き込む値をJSONのバイト列にする"""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode()
 
 # Global Configuration
 max_time = 10.0
@@ -27,9 +142,138 @@ max_api_wait_time = (3.0, 5.0)
 failed = "Load Failed"
 MAX_RETRIES = 10   # ストリームAPIリトライ回数
 RETRY_DELAY = 1.0 # ストリームAPIリトライ待機時間 (秒)
+HEDGE_ENABLED = True   # Invidiousへのヘッジ(並列フェイルオーバー)要求を有効にする
+HEDGE_DELAY = 0.5      # 次のインスタンスへ追加で要求を投げるまでの待機時間 (秒)
+HEDGE_MAX_INFLIGHT = 3 # 同時に待機するインスタンス数の上限
+
+# 共有HTTPクライアントの接続プール設定
+HTTP_MAX_CONNECTIONS = 200      # 全体の同時接続数上限
+HTTP_MAX_KEEPALIVE = 50         # 保持するkeep-alive接続数の上限
+HTTP_MAX_PER_HOST = 20          # 1ホストあたりの同時要求数上限
+HTTP_KEEPALIVE_EXPIRY = 30.0    # アイドル接続を保持する時間 (秒)
+HTTP_HOST_QUEUE = 100           # 1ホストあたりの待ち行列の長さ (超えた要求はすぐに断る)
+HTTP_HOST_MAX_WAIT = 2.0        # 1ホストの空きを待つ最大時間 (秒)
+HTTP_HOST_LIMITS_MAX = 256      # ホストごとのリミッターを保持する数の上限 (超えたら使われていないものを捨てる)
+
+# 流量制御設定 (ルート種別ごとの同時処理数。上限を超えたら短く待たせ、それでも空かなければ503を返す)
+ADMISSION_CLASSES = {           # ルート種別: (同時処理数, 待ち行列の長さ, 最大待ち時間 (秒))
+    'page': (64, 128, 5.0),
+    'api': (32, 64, 3.0),
+    'thumbnail': (32, 64, 1.0),
+    'suggest': (16, 16, 0.3),
+}
+ADMISSION_PRIORITY = {'page': 0, 'api': 1, 'thumbnail': 2, 'suggest': 3}  # 上流の空きを待つときの優先度 (小さいほど優先)
+PRIORITY_BACKGROUND = 2         # リクエストに紐づかない処理 (バックグラウンドの再取得など) の優先度
+REQUEST_DEADLINES = {           # ルート種別ごとの処理期限 (秒)。上流への要求はこの残り時間内で打ち切る
+    'page': max_time,
+    'api': max_time,
+    'thumbnail': 5.0,
+    'suggest': 3.0,
+}
+
+# Invidiousレスポンスキャッシュ設定
+CACHE_TTL = {                   # カテゴリごとの有効期間 (秒)
+    'video': 300,
+    'search': 30,
+    'channel': 600,
+    'playlist': 600,
+    'comments': 120,
+    'trending': 300,
+}
+CACHE_STALE_TIME = 600          # 期限切れ後も古い値を返しつつ裏で再取得する猶予 (秒)
+CACHE_MAX_ENTRIES = 2000
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# インスタンス健全性 / サーキットブレーカー設定
+HEALTH_EWMA_ALPHA = 0.3         # レイテンシ・エラー率の指数移動平均の重み
+CIRCUIT_FAILURE_THRESHOLD = 3   # 連続失敗がこの回数に達したらサーキットを開く
+CIRCUIT_OPEN_TIME = 30.0        # サーキットを開いてから再プローブするまでの時間 (秒)
+HEALTH_PROBE_INTERVAL = 10.0    # バックグラウンドプローブの実行間隔 (秒)
+HEALTH_PROBE_PATHS = {          # カテゴリごとのプローブ先 (未指定は /stats)
+    'video': '/videos/jNQXAC9IVRw',
+    'search': '/search?q=youtube',
+    'comments': '/comments/jNQXAC9IVRw',
+}
 
 # 新規追加: /api/edu で使用する外部ストリームAPIのURL
 EDU_STREAM_API_BASE_URL = "https://siawaseok.duckdns.org/api/stream/" 
+EDU_KEY_API_URL = "https://apis.kahoot.it/media-api/youtube/key"
+# 360p / 高画質ストリームの取得に使う外部API
+YTDL_API_BASE_URL = "https://pmpmpm.onrender.com/dl/"
+THUMBNAIL_URL = "https://img.youtube.com/vi/{}/0.jpg"
+SUGGEST_URL = "http://www.google.com/complete/search?client=youtube&hl=ja&ds=yt&q="
+STREAM_URL_EXPIRY_MARGIN = 60   # 署名付きストリームURLの期限より早めにインデックスを破棄する (秒)
+STREAM_INDEX_DEFAULT_TTL = 300  # expire パラメータが見つからない場合のインデックス保持時間 (秒)
+STREAM_WATCH_PAGE = True        # /watch をストリーミング描画する (ページの外枠を先に送信する)
+
+# サムネイルキャッシュ設定
+THUMBNAIL_CACHE_DIR = Path(os.environ.get("THUMBNAIL_CACHE_DIR", Path(tempfile.gettempdir()) / "yuzutube-thumbnails"))
+THUMBNAIL_CACHE_MAX_BYTES = 256 * 1024 * 1024   # ディスクキャッシュの上限
+THUMBNAIL_MEMORY_MAX_BYTES = 16 * 1024 * 1024   # メモリ上のホットキャッシュの上限
+THUMBNAIL_MAX_AGE = 86400                       # ブラウザ/CDNに許可するキャッシュ時間 (秒)
+
+# HTTPキャッシュと圧縮の設定
+PAGE_MAX_AGE = {                # ルートごとにブラウザ/CDNへ許可するキャッシュ時間 (秒)。ここに無いルートには Cache-Control を付けない
+    '/': 60,
+    '/trending': 300,
+    '/search': CACHE_TTL['search'],
+    '/channel/{channelid}': CACHE_TTL['channel'],
+    '/playlist': CACHE_TTL['playlist'],
+    '/api/playlist/{listid}': CACHE_TTL['playlist'],
+    '/comments': CACHE_TTL['comments'],
+    '/comments/fragment': CACHE_TTL['comments'],
+}
+PAGE_STALE_WHILE_REVALIDATE = 60    # 期限切れのページをCDNが返しつつ裏で再検証してよい時間 (秒)
+COMPRESS_TYPES = ("text/html", "text/css", "text/javascript", "application/javascript", "application/json", "application/x-ndjson", "image/svg+xml")
+COMPRESS_MIN_SIZE = 1024            # これより小さい応答は圧縮しない (バイト)
+GZIP_LEVEL = 6                      # 動的な応答の圧縮レベル。静的ファイルはビルド時に最高レベルで圧縮する
+BROTLI_QUALITY = 5
+STATIC_MAX_AGE = 365 * 86400        # フィンガープリント付きURLの静的ファイルのキャッシュ時間 (immutable)
+STATIC_REVALIDATE_MAX_AGE = 300     # フィンガープリントの無いURLの静的ファイルのキャッシュ時間 (秒)
+NO_STORE_HEADERS = {"Cache-Control": "no-store"}  # 取得に失敗した代わりの内容を返すページはキャッシュさせない
+
+# 検索候補 (/suggest) 設定
+SUGGEST_TTL = 600               # 候補をキャッシュする時間 (秒)
+SUGGEST_MAX_ENTRIES = 20000
+SUGGEST_MAX_RESULTS = 10        # Googleが返す候補数の上限。これ未満なら候補は出尽くしている
+SUGGEST_TIMEOUT = (2.0, 3.0)
+
+# メディアプロキシ設定 (proxy Cookie が有効な場合に googlevideo のストリームを中継する)
+MEDIA_PROXY_HOSTS = (".googlevideo.com",)       # 中継を許可するホスト (サフィックス一致)
+MEDIA_PROXY_MAX_STREAMS = 64                    # 同時に中継するストリーム数の上限
+MEDIA_PROXY_CHUNK_SIZE = 64 * 1024              # 1回に転送するチャンクの大きさ (ストリームあたりのメモリ上限)
+MEDIA_PROXY_TIMEOUT = (5.0, 30.0)               # (接続, 読み取り) タイムアウト (秒)
+MEDIA_PROXY_REQUEST_HEADERS = ("range", "if-range", "if-none-match", "if-modified-since")
+MEDIA_PROXY_RESPONSE_HEADERS = ("content-type", "content-length", "content-range", "accept-ranges", "content-encoding", "etag", "last-modified", "cache-control")
+
+# ワーカー間の共有ストア設定 (uvicorn --workers などで複数プロセスを動かす場合)
+# 未設定ならプロセス内のキャッシュだけを使う。"sqlite:///path/to/store.db" (WALモード) か "redis://host:6379/0" を指定する
+SHARED_STORE_URL = os.environ.get("SHARED_STORE_URL", "")
+SHARED_STORE_PREFIX = "yuzutube:"
+SHARED_SYNC_INTERVAL = 2.0      # インスタンスの健全性をほかのワーカーと同期する間隔 (秒)
+SHARED_PRUNE_INTERVAL = 500     # SQLite: この回数書き込むごとに期限切れの行を削除する
+EDU_KEY_TTL = 600               # Kahootのキーを使い回す時間 (秒)
+
+# 一括取得API設定 (/api/batch/videos)
+BATCH_MAX_VIDEOS = 50           # 1回の要求で受け付ける動画IDの上限
+BATCH_CONCURRENCY = 8           # 1回の要求で同時に上流へ問い合わせる数
+
+# 急上昇のスナップショット設定 (バックグラウンドで定期的に取得し、/trending とホームはメモリから返す)
+TRENDING_REGIONS = tuple(r.strip().upper() for r in os.environ.get("TRENDING_REGIONS", "JP").split(",") if r.strip())
+TRENDING_REFRESH_INTERVAL = 300 # スナップショットを更新する間隔 (秒)
+TRENDING_RETRY_INTERVAL = 60    # 取得に失敗したときに再試行するまでの間隔 (秒)。その間は古いスナップショットを返す
+TRENDING_REFRESH_JITTER = 0.2   # 更新間隔を ±この割合でずらし、複数ワーカーやリージョンの取得が重ならないようにする
+TRENDING_HOME_COUNT = 12        # ホームに表示する動画数
+
+# コメントのページキャッシュ設定 ((動画ID, continuation) ごとに整形済みのページを保持する)
+COMMENTS_PAGE_MAX_ENTRIES = 5000
+COMMENTS_PAGE_MAX_BYTES = 32 * 1024 * 1024
+
+# プレイリスト全体の取得設定 (/playlist?all=1)
+PLAYLIST_CONCURRENCY = 4        # 同時に取得するページ数
+PLAYLIST_MAX_PAGES = 50         # 取得するページ数の上限 (これを超える分は読み込まない)
+PLAYLIST_CACHE_MAX_ENTRIES = 200
+PLAYLIST_CACHE_MAX_BYTES = 32 * 1024 * 1024
 
 
 invidious_api_data = {
@@ -75,57 +319,593 @@ invidious_api_data = {
     ]
 }
 
+class InstanceHealth:
+    """1インスタンス × 1カテゴリの健全性 (レイテンシ・エラー率のEWMAとサーキット状態)"""
+    def __init__(self, url):
+        self.url = url
+        self.latency = None        # 成功時レイテンシのEWMA (秒)
+        self.error_rate = 0.0      # 失敗率のEWMA (0.0〜1.0)
+        self.successes = 0
+        self.failures = 0
+        self.invalid_json = 0
+        self.consecutive_failures = 0
+        self.circuit_open = False
+        self.next_probe = 0.0
+        self.updated = 0.0         # 最後に状態が変わった時刻 (ワーカー間の同期に使う)
+        self.synced = 0.0          # 最後に共有ストアと同期した時点の updated
+
+    # ワーカー間で共有する項目 (successes などの件数はプロセスごとの統計として共有しない)
+    SHARED_FIELDS = ("latency", "error_rate", "consecutive_failures", "circuit_open", "next_probe", "updated")
+
+    def state(self):
+        return {name: getattr(self, name) for name in self.SHARED_FIELDS}
+
+    def load(self, state):
+        for name in self.SHARED_FIELDS:
+            setattr(self, name, state[name])
+        self.synced = self.updated
+
+    def record_success(self, latency):
+        self.latency = latency if self.latency is None else HEALTH_EWMA_ALPHA * latency + (1 - HEALTH_EWMA_ALPHA) * self.latency
+        self.error_rate *= (1 - HEALTH_EWMA_ALPHA)
+        self.successes += 1
+        self.consecutive_failures = 0
+        self.circuit_open = False
+        self.updated = time.time()
+
+    def record_failure(self, invalid_json=False):
+        self.error_rate = HEALTH_EWMA_ALPHA + (1 - HEALTH_EWMA_ALPHA) * self.error_rate
+        self.failures += 1
+        self.consecutive_failures += 1
+        if invalid_json:
+            self.invalid_json += 1
+        if self.consecutive_failures >= CIRCUIT_FAILURE_THRESHOLD:
+            self.circuit_open = True
+            self.next_probe = time.time() + CIRCUIT_OPEN_TIME
+        self.updated = time.time()
+
+    def score(self):
+        # 小さいほど優先。未計測のインスタンスは平均的な値として扱う
+        latency = self.latency if self.latency is not None else max_api_wait_time[1] / 5
+        return latency * (1 + 4 * self.error_rate)
+
+
+class InstancePool:
+    """
+    カテゴリごとのInvidiousインスタンス一覧。
+    イテレートすると健全なインスタンスを速い順に返し、サーキットが開いているものは除外する。
+    """
+    def __init__(self, category, urls):
+        self.category = category
+        self.urls = list(dict.fromkeys(urls))  # 重複を除去 (順序は維持)
+        self.health = {url: InstanceHealth(url) for url in self.urls}
+        self._lock = threading.Lock()
+
+    def ranked(self):
+        with self._lock:
+            order = {url: n for n, url in enumerate(self.urls)}
+            healthy = [h for h in self.health.values() if not h.circuit_open]
+            if not healthy:
+                # すべて開いている場合は、最も早く再プローブ予定のものから試す
+                return [h.url for h in sorted(self.health.values(), key=lambda h: h.next_probe)]
+            return [h.url for h in sorted(healthy, key=lambda h: (h.score(), order[h.url]))]
+
+    def __iter__(self):
+        return iter(self.ranked())
+
+    def __len__(self):
+        return len(self.urls)
+
+    def record_success(self, url, latency):
+        with self._lock:
+            self.health[url].record_success(latency)
+
+    def record_failure(self, url, invalid_json=False):
+        with self._lock:
+            self.health[url].record_failure(invalid_json)
+
+    def record_latency(self, url, latency):
+        # 成功/失敗を判定できない (キャンセルされた) 要求のレイテンシだけを反映する
+        with self._lock:
+            health = self.health[url]
+            if health.latency is None:
+                health.latency = latency
+            elif latency > health.latency:
+                health.latency = HEALTH_EWMA_ALPHA * latency + (1 - HEALTH_EWMA_ALPHA) * health.latency
+            else:
+                return
+            health.updated = time.time()
+
+    def due_for_probe(self):
+        now = time.time()
+        with self._lock:
+            return [h.url for h in self.health.values() if h.circuit_open and h.next_probe <= now]
+
+    def defer_probe(self, url):
+        with self._lock:
+            health = self.health[url]
+            health.next_probe = time.time() + CIRCUIT_OPEN_TIME
+            health.updated = time.time()
+
+    async def sync(self, store):
+        """
+        各インスタンスの健全性を共有ストアと突き合わせる。前回の同期以降に手元で変化があれば書き込み、
+        ほかのワーカーがより新しい状態を書き込んでいればそれを取り込む。
+        """
+        for url in self.urls:
+            key = f"health:{self.category}:{url}"
+            remote = await store.get(key)
+            remote = json.loads(remote[0]) if remote is not None else None
+            with self._lock:
+                health = self.health[url]
+                if remote is not None and remote["updated"] > health.updated:
+                    health.load(remote)
+                    continue
+                if health.updated <= health.synced:
+                    continue
+                state = health.state()
+                health.synced = health.updated
+            await store.set(key, json.dumps(state).encode(), CIRCUIT_OPEN_TIME * 10, 0)
+
+
 class InvidiousAPI:
     def __init__(self):
         self.all = invidious_api_data
-        self.video = list(self.all['video']); 
-        self.playlist = list(self.all['playlist']);
-        self.search = list(self.all['search']); 
-        self.channel = list(self.all['channel']);
-        self.comments = list(self.all['comments']); 
+        self.video = InstancePool('video', self.all['video'])
+        self.playlist = InstancePool('playlist', self.all['playlist'])
+        self.search = InstancePool('search', self.all['search'])
+        self.channel = InstancePool('channel', self.all['channel'])
+        self.comments = InstancePool('comments', self.all['comments'])
         self.check_video = False
 
-def requestAPI(path, api_urls):
+    def pools(self):
+        return [self.video, self.playlist, self.search, self.channel, self.comments]
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, labels
+        self.values = {}
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for label_values, value in self.values.items():
+            yield f"{self.name}{_labels(self.labels, label_values)} {value}"
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        self.values = {}  # ラベル -> [バケットごとの件数..., 合計, 件数]
+
+    def observe(self, value, *label_values):
+        entry = self.values.get(label_values)
+        if entry is None:
+            entry = self.values[label_values] = [0] * (len(self.buckets) + 2)
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            entry[index] += 1
+        entry[-2] += value
+        entry[-1] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for label_values, entry in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, entry):
+                cumulative += count
+                yield f"{self.name}_bucket{_labels(self.labels + ('le',), label_values + (repr(bound),))} {cumulative}"
+            yield f"{self.name}_bucket{_labels(self.labels + ('le',), label_values + ('+Inf',))} {entry[-1]}"
+            yield f"{self.name}_sum{_labels(self.labels, label_values)} {entry[-2]}"
+            yield f"{self.name}_count{_labels(self.labels, label_values)} {entry[-1]}"
+
+
+class CallbackMetric:
+    """値をスクレイプ時に関数で求めるメトリクス。func は (ラベル値のタプル, 値) を列挙する。"""
+    def __init__(self, name, help, labels, func, kind="gauge"):
+        self.name, self.help, self.labels, self.func, self.kind = name, help, labels, func, kind
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for label_values, value in self.func():
+            yield f"{self.name}{_labels(self.labels, label_values)} {value}"
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+
+class Metrics:
+    """Prometheus のテキスト形式で /metrics に出力するメトリクス"""
+    def __init__(self):
+        self.route_latency = Histogram("yuzutube_http_request_duration_seconds", "Request latency per route.", ("route", "method", "status"))
+        self.requests_in_flight = 0
+        self.media_streams = 0
+        self.upstream_latency = Histogram("yuzutube_upstream_request_duration_seconds", "Upstream request latency (until response headers) per upstream.", ("upstream",))
+        self.upstream_failures = Counter("yuzutube_upstream_failures_total", "Failed upstream requests per upstream and reason.", ("upstream", "reason"))
+        self.cancelled_requests = Counter("yuzutube_requests_cancelled_total", "Requests cancelled because the client disconnected.", ("route",))
+        self.failover_depth = Histogram("yuzutube_failover_depth", "Number of Invidious instances tried per requestAPI call.", ("category",), buckets=(1, 2, 3, 4, 5, 6, 8))
+        self.callbacks = []
+
+    def callback(self, name, help, labels, func, kind="gauge"):
+        self.callbacks.append(CallbackMetric(name, help, labels, func, kind))
+
+    def render(self):
+        lines = []
+        for metric in [self.route_latency, self.upstream_latency, self.upstream_failures, self.failover_depth, self.cancelled_requests, *self.callbacks]:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+def upstreamLabel(url):
+    """メトリクスのラベルにする上流名。googlevideo のようにホストが無数にあるものはまとめる。"""
+    parts = urllib.parse.urlsplit(url)
+    host = parts.hostname or ""
+    for suffix in MEDIA_PROXY_HOSTS:
+        if host.endswith(suffix):
+            return suffix.lstrip(".")
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def create_http_client():
+    """アプリケーション全体で共有する非同期HTTPクライアントを作成する (ホストごとにkeep-aliveプールを持つ)"""
+    try:
+        import h2  # noqa: F401  HTTP/2 は h2 がインストールされている場合のみ有効
+        http2 = True
+    except ImportError:
+        http2 = False
+    return httpx.AsyncClient(
+        http2=http2,
+        headers=getRandomUserAgent(),
+        timeout=httpx.Timeout(max_api_wait_time[1], connect=max_api_wait_time[0]),
+        limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE, keepalive_expiry=HTTP_KEEPALIVE_EXPIRY),
+        follow_redirects=True,
+    )
+
+class Overloaded(Exception):
+    """流量制御で要求を断った。Retry-After 付きの503として返す。"""
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name} is overloaded.")
+        self.name = name
+        self.retry_after = retry_after
+
+
+request_priority = contextvars.ContextVar("request_priority", default=PRIORITY_BACKGROUND)
+request_deadline = contextvars.ContextVar("request_deadline", default=None)  # 処理中のリクエストの期限 (time.time() の値)
+
+def upstreamDeadline(budget):
+    """budget 秒後とリクエストの期限の早いほうを返す"""
+    deadline = time.time() + budget
+    request = request_deadline.get()
+    return deadline if request is None else min(deadline, request)
+
+def boundedTimeout(timeout):
+    """(接続, 読み取り) タイムアウトをリクエストの残り時間に収める"""
+    request = request_deadline.get()
+    if request is None:
+        return timeout
+    remaining = request - time.time()
+    if remaining <= 0:
+        raise httpx.TimeoutException("The request deadline has passed.")
+    return (min(timeout[0], remaining), min(timeout[1], remaining))
+
+async def withinDeadline(coro):
+    """
+    リクエストの期限までに終わらなければ打ち切る。httpx のタイムアウトは接続・読み取りの
+    1回ごとにしか効かないため、少しずつ届く応答でも期限を超えないようにする。
+    """
+    request = request_deadline.get()
+    if request is None:
+        return await coro
+    try:
+        return await asyncio.wait_for(coro, request - time.time())
+    except asyncio.TimeoutError:
+        raise httpx.TimeoutException("The request deadline has passed.") from None
+
+class AdmissionLimiter:
+    """
+    同時実行数の上限と短い待ち行列を持つリミッター。空きが出たら優先度の高い (値の小さい) 待機者から通す。
+    待ち行列が一杯のとき、または予想待ち時間が最大待ち時間を超えるときは、待たせずに Overloaded を投げる。
+    """
+    def __init__(self, name, limit, max_queue, max_wait):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.active = 0
+        self.rejected = 0
+        self.hold_time = None  # 1回の処理で枠を使う時間のEWMA (秒)
+        self._waiters = []     # (優先度, 順番, future) のヒープ
+        self._order = 0
+
+    def expected_wait(self):
+        if self.hold_time is None:
+            return 0.0
+        return self.hold_time * (len(self._waiters) + 1) / self.limit
+
+    def _reject(self):
+        self.rejected += 1
+        raise Overloaded(self.name, max(1, round(self.expected_wait())))
+
+    async def acquire(self, priority=None):
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return
+        if len(self._waiters) >= self.max_queue or self.expected_wait() > self.max_wait:
+            self._reject()
+
+        priority = request_priority.get() if priority is None else priority
+        max_wait = self.max_wait
+        if request_deadline.get() is not None:
+            max_wait = min(max_wait, request_deadline.get() - time.time())
+        self._order += 1
+        entry = (priority, self._order, asyncio.get_running_loop().create_future())
+        heapq.heappush(self._waiters, entry)
+        try:
+            await asyncio.wait_for(entry[2], max(max_wait, 0))
+        except asyncio.TimeoutError:
+            self._reject()
+        except BaseException:
+            if entry[2].done() and not entry[2].cancelled():
+                self.release()  # 枠を受け取った直後にキャンセルされた
+            raise
+        finally:
+            if entry in self._waiters:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+
+    def release(self, held=None):
+        if held is not None:
+            self.hold_time = held if self.hold_time is None else HEALTH_EWMA_ALPHA * held + (1 - HEALTH_EWMA_ALPHA) * self.hold_time
+        while self._waiters:
+            _, _, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                waiter.set_result(None)  # 枠をそのまま次の待機者に渡す
+                return
+        self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self, priority=None):
+        await self.acquire(priority)
+        starttime = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(time.perf_counter() - starttime)
+
+
+http_client = None
+_host_limits = {}
+_evicted_rejections = {}  # 捨てたリミッターの rejected (メトリクスの値が減らないように上流名ごとに足しておく)
+
+def get_http_client():
+    # 通常はlifespanで作成済み。lifespanを経由しない実行環境向けに遅延作成もする
+    global http_client
+    if http_client is None:
+        http_client = create_http_client()
+    return http_client
+
+def _host_limit(url):
+    host = urllib.parse.urlsplit(url).netloc
+    limit = _host_limits.get(host)
+    if limit is None:
+        if len(_host_limits) >= HTTP_HOST_LIMITS_MAX:
+            _evictIdleHostLimits()
+        limit = _host_limits[host] = AdmissionLimiter(upstreamLabel(url), HTTP_MAX_PER_HOST, HTTP_HOST_QUEUE, HTTP_HOST_MAX_WAIT)
+    return limit.slot()
+
+def _evictIdleHostLimits():
+    """googlevideo のようにホストが無数にある上流でリミッターが溜まり続けないよう、使われていないものを捨てる"""
+    for host, limit in list(_host_limits.items()):
+        if limit.active == 0 and not limit._waiters:
+            del _host_limits[host]
+            _evicted_rejections[limit.name] = _evicted_rejections.get(limit.name, 0) + limit.rejected
+
+async def _observed(url, send):
+    """上流への要求のレイテンシと失敗をメトリクスに記録する"""
+    upstream = upstreamLabel(url)
+    starttime = time.perf_counter()
+    try:
+        res = await send()
+    except httpx.HTTPError as e:
+        metrics.upstream_failures.inc(upstream, type(e).__name__)
+        raise
+    finally:
+        metrics.upstream_latency.observe(time.perf_counter() - starttime, upstream)
+    if res.status_code >= 400:
+        metrics.upstream_failures.inc(upstream, f"http_{res.status_code}")
+    return res
+
+async def http_get(url, timeout=max_api_wait_time, **kwargs):
+    """
+    共有クライアントでGETする。ホストごとの同時接続数は HTTP_MAX_PER_HOST に制限され、
+    空きを待ちきれない場合は Overloaded を投げる。タイムアウトはリクエストの残り時間で切り詰める。
+    """
+    timeout = boundedTimeout(timeout)
+    async with _host_limit(url):
+        return await _observed(url, lambda: withinDeadline(get_http_client().get(url, timeout=httpx.Timeout(timeout[1], connect=timeout[0]), **kwargs)))
+
+async def http_stream(url, timeout=max_api_wait_time, headers=None):
+    """
+    ボディを読まずにレスポンスを返す (ストリーミング用)。呼び出し側で必ず aclose() すること。
+    ホストごとの同時接続数の制限はヘッダー受信までに適用される。
+    """
+    client = get_http_client()
+    timeout = boundedTimeout(timeout)
+    request = client.build_request("GET", url, headers=headers, timeout=httpx.Timeout(timeout[1], connect=timeout[0]))
+    async with _host_limit(url):
+        return await _observed(url, lambda: withinDeadline(client.send(request, stream=True)))
+
+class UpstreamResponse:
+    """上流の1回の応答。デコード済みのJSON (data) と、キャッシュの大きさの見積もりに使う元のバイト列 (raw)"""
+    __slots__ = ("data", "raw")
+
+    def __init__(self, data, raw):
+        self.data = data
+        self.raw = raw
+
+
+async def _fetchAPI(api, path, timeout, pool=None):
+    """1インスタンスへの要求。正常なJSONが返らなければ例外を投げる。結果はpoolの健全性に記録する。"""
+    starttime = time.time()
+    try:
+        res = await http_get(api + 'api/v1' + path, timeout=timeout)
+    except httpx.HTTPError:
+        if pool is not None:
+            pool.record_failure(api)
+        raise
+    except asyncio.CancelledError:
+        # ヘッジで負けた要求。少なくともこれだけ遅かったことは記録しておく
+        if pool is not None:
+            pool.record_latency(api, time.time() - starttime)
+        raise
+
+    if res.status_code == httpx.codes.OK:
+        try:
+            data = decodeJSON(res.content)
+        except ValueError:
+            metrics.upstream_failures.inc(upstreamLabel(api), "invalid_json")
+        else:
+            if pool is not None:
+                pool.record_success(api, time.time() - starttime)
+            return UpstreamResponse(data, res.content)
+
+    if pool is not None:
+        pool.record_failure(api, invalid_json=res.status_code == httpx.codes.OK)
+    raise APITimeoutError(f"{api} returned status {res.status_code} or invalid JSON.")
+
+async def requestAPI(path, api_urls):
+    """
+    Attempts API requests using the provided list of URLs.
+    In hedged mode the next URL is started after HEDGE_DELAY seconds (or right away
+    when a try fails) and the first valid JSON response wins; the remaining tries are
+    cancelled. Every try is bounded by the overall max_time budget and the deadline
+    of the request being served. Returns an UpstreamResponse whose JSON is already decoded.
+    """
+    if not HEDGE_ENABLED:
+        return await requestAPISequential(path, api_urls)
+
+    deadline = upstreamDeadline(max_time - 1)
+    pool = api_urls if isinstance(api_urls, InstancePool) else None
+    apis_to_try = iter(list(api_urls))
+    pending = set()
+    launched = []
+
+    def launch_next():
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        api = next(apis_to_try, None)
+        if api is None:
+            return False
+        timeout = (min(max_api_wait_time[0], remaining), min(max_api_wait_time[1], remaining))
+        pending.add(asyncio.ensure_future(_fetchAPI(api, path, timeout, pool)))
+        launched.append(api)
+        return True
+
+    try:
+        launch_next()
+        while pending:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            done, _ = await asyncio.wait(pending, timeout=min(HEDGE_DELAY, remaining), return_when=asyncio.FIRST_COMPLETED)
+            pending -= done
+
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+
+            if done:
+                # 失敗したぶんだけ即座に次のインスタンスへ
+                for _ in done:
+                    launch_next()
+            elif len(pending) < HEDGE_MAX_INFLIGHT:
+                # 応答が遅いのでヘッジ要求を追加
+                launch_next()
+    finally:
+        # 残りの要求はキャンセルして接続を解放する
+        for task in pending:
+            task.cancel()
+        metrics.failover_depth.observe(len(launched), pool.category if pool else "")
+
+    # APIFailoverがすべて失敗した場合、例外を投げる
+    raise APITimeoutError("All available API instances failed to respond.")
+
+async def requestAPISequential(path, api_urls):
     """
     Sequentially attempts API requests using the provided list of URLs.
     Fails over to the next URL on connection error or non-OK response.
     """
-    starttime = time.time()
+    deadline = upstreamDeadline(max_time - 1)
+    pool = api_urls if isinstance(api_urls, InstancePool) else None
     
-    apis_to_try = api_urls
+    apis_to_try = list(api_urls)
+    depth = 0
     
-    for api in apis_to_try:
-        if time.time() - starttime >= max_time - 1:
-            break
-            
-        try:
-            res = requests.get(api + 'api/v1' + path, headers=getRandomUserAgent(), timeout=max_api_wait_time)
-            
-            if res.status_code == requests.codes.ok and isJSON(res.text):
-                return res.text
-            
-        except requests.exceptions.RequestException:
-            continue
+    try:
+        for api in apis_to_try:
+            if time.time() >= deadline:
+                break
+                
+            depth += 1
+            try:
+                return await _fetchAPI(api, path, max_api_wait_time, pool)
+            except (httpx.HTTPError, APITimeoutError, Overloaded):
+                continue
+    finally:
+        metrics.failover_depth.observe(depth, pool.category if pool else "")
             
     # APIFailoverがすべて失敗した場合、例外を投げる
     raise APITimeoutError("All available API instances failed to respond.")
-def getEduKey():
+
+async def getEduKey():
+    """
+    KahootのYouTubeキーを返す。EDU_KEY_TTL の間はプロセス内と共有ストアのキーを使い回す。
+    """
+    entry = response_cache.get("edu:key")
+    if entry is not None:
+        return entry[0]
+
+    async def load():
+        shared = await sharedGet("edu:key")
+        if shared is not None and shared[1] > 0:
+            key = shared[0].decode()
+            response_cache.set("edu:key", key, shared[1], len(key), stale=0)
+            return key
+        key = await fetchEduKey()
+        if key:
+            response_cache.set("edu:key", key, EDU_KEY_TTL, len(key), stale=0)
+            sharedPublish("edu:key", key.encode(), EDU_KEY_TTL, stale=0)
+        return key
+
+    return await upstream_flight.do("edu:key", load)
+
+async def fetchEduKey():
     """
     KahootのメディアAPIからYouTubeのキーを取得する
     URL: https://apis.kahoot.it/media-api/youtube/key
     """
-    api_url = "https://apis.kahoot.it/media-api/youtube/key"
     try:
-        res = requests.get(api_url, headers=getRandomUserAgent(), timeout=max_api_wait_time)
+        res = await http_get(EDU_KEY_API_URL)
         res.raise_for_status() # HTTPエラーを確認
         
-        if isJSON(res.text):
-            data = json.loads(res.text)
-            return data.get("key")
+        data = decodeJSON(res.content)
+        return data.get("key")
         
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"Kahoot API request failed: {e}")
-    except json.JSONDecodeError:
+    except ValueError:
         print("Kahoot API returned non-JSON data.")
     
     return None
@@ -142,46 +922,549 @@ def formatSearchData(data_dict, failed="Load Failed"):
         return {"type": "channel", "author": data_dict.get("author", failed), "id": data_dict.get("authorId", failed), "thumbnail": thumbnail}
     return {"type": "unknown", "data": data_dict}
 
+class ResponseCache:
+    """
+    TTL + LRU のインメモリキャッシュ。エントリ数とおおよそのサイズ(バイト)の両方で上限を設ける。
+    期限切れでも stale 期間内のエントリは古い値として返す (再取得は呼び出し側が行う)。
+    """
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()  # key -> (value, size, expires, stale_until)
+
+    def get(self, key):
+        """(value, fresh) を返す。存在しないか stale 期間も過ぎていれば None。"""
+        entry = self._data.get(key)
+        now = time.time()
+        if entry is None or entry[3] <= now:
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        if entry[2] > now:
+            self.hits += 1
+            return entry[0], True
+        self.stale_hits += 1
+        return entry[0], False
+
+    def set(self, key, value, ttl, size, stale=CACHE_STALE_TIME):
+        if key in self._data:
+            self._remove(key)
+        now = time.time()
+        self._data[key] = (value, size, now + ttl, now + ttl + stale)
+        self.size += size
+        while self._data and (len(self._data) > self.max_entries or self.size > self.max_bytes):
+            self._remove(next(iter(self._data)))
+            self.evictions += 1
+
+    def invalidate(self, key):
+        if key in self._data:
+            self._remove(key)
+
+    def _remove(self, key):
+        self.size -= self._data.pop(key)[1]
+
+    def stats(self):
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            "entries": len(self._data), "bytes": self.size,
+            "hits": self.hits, "stale_hits": self.stale_hits, "misses": self.misses, "evictions": self.evictions,
+            "hit_ratio": (self.hits + self.stale_hits) / lookups if lookups else 0.0,
+        }
+
+
+response_cache = ResponseCache(CACHE_MAX_ENTRIES, CACHE_MAX_BYTES)
+_background_tasks = set()
+
+def spawn_background(coro):
+    # タスクの参照を保持しておかないと途中でGCされることがある
+    task = asyncio.ensure_future(_detached(coro))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+async def _detached(coro, priority=PRIORITY_BACKGROUND):
+    # 起動したリクエストの期限や優先度は引き継がない (タスクはコンテキストのコピーで動くので元には影響しない)
+    request_deadline.set(None)
+    request_priority.set(priority)
+    return await coro
+
+class SingleFlight:
+    """
+    同じキーの処理が実行中なら、新たに実行せずその結果を待つ (リクエストの合流)。
+    共有する処理は最初の呼び出し元の期限を引き継がずに動かし、呼び出し元はそれぞれ自分の期限まで待つ。
+    呼び出し元の一部がキャンセルされたり期限を過ぎたりしても共有中の処理は続け、待っている呼び出し元が
+    いなくなったら処理もキャンセルする。例外は待っている全員に伝わる。
+    """
+    def __init__(self):
+        self.shared = 0  # 合流した呼び出し数
+        self._inflight = {}  # キー -> [タスク, 待機中の呼び出し数]
+
+    async def do(self, key, func):
+        entry = self._inflight.get(key)
+        if entry is None:
+            task = asyncio.ensure_future(_detached(func(), request_priority.get()))
+            entry = self._inflight[key] = [task, 0]
+            task.add_done_callback(lambda t: self._done(key, t))
+        else:
+            self.shared += 1
+        task = entry[0]
+        entry[1] += 1
+        try:
+            deadline = request_deadline.get()
+            if deadline is None:
+                return await asyncio.shield(task)
+            try:
+                return await asyncio.wait_for(asyncio.shield(task), deadline - time.time())
+            except asyncio.TimeoutError:
+                raise APITimeoutError("The request deadline has passed.") from None
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and not task.done():
+                # 最後の待機者。結果を使う者がいないので上流への要求ごと打ち切る
+                task.cancel()
+                if self._inflight.get(key) is entry:
+                    del self._inflight[key]
+
+    def _done(self, key, task):
+        entry = self._inflight.get(key)
+        if entry is not None and entry[0] is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # 待機者が全員いなくなった場合の "never retrieved" 警告を防ぐ
+
+upstream_flight = SingleFlight()
+
+
+class SharedStore:
+    """
+    ワーカー間で共有するキー・値ストア (値はバイト列) の共通部分。
+    値には期限と stale 期限を付けて保存し、get は (値, 期限, stale期限) を返す。
+    プロセス内のキャッシュに無いときにだけ参照するため、上流への要求をワーカー数ぶん重ねずに済む。
+    """
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _encode(data, expires, stale_until):
+        return f"{expires:.3f} {stale_until:.3f}\n".encode() + data
+
+    async def get(self, key):
+        blob = await self._get(SHARED_STORE_PREFIX + key)
+        if blob is not None:
+            header, _, data = blob.partition(b"\n")
+            expires, stale_until = map(float, header.split())
+            if stale_until > time.time():
+                self.hits += 1
+                return data, expires, stale_until
+        self.misses += 1
+        return None
+
+    async def set(self, key, data, ttl, stale=CACHE_STALE_TIME):
+        now = time.time()
+        await self._set(SHARED_STORE_PREFIX + key, self._encode(data, now + ttl, now + ttl + stale), ttl + stale)
+
+    async def delete(self, key):
+        await self._delete(SHARED_STORE_PREFIX + key)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_ratio": self.hits / lookups if lookups else 0.0}
+
+
+class SQLiteStore(SharedStore):
+    """
+    WALモードのSQLiteファイルを使う共有ストア。同じホスト上のワーカー同士で使う。
+    読み取りは主キーの参照だけなので、イベントループ上で直接行う (数十マイクロ秒程度)。
+    書き込みはほかのプロセスのロックを待つことがあるため、スレッドプールで行う。
+    """
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._reader = self._connect()
+        self._writer = self._connect()
+        self._writer.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL)")
+        self._read_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._writes = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=1.0, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA mmap_size=67108864")
+        return conn
+
+    async def _get(self, key):
+        with self._read_lock:
+            try:
+                row = self._reader.execute("SELECT value FROM kv WHERE key = ? AND expires_at > ?", (key, time.time())).fetchone()
+            except sqlite3.OperationalError:
+                return None  # ロック待ちがタイムアウトした場合などはキャッシュなしとして扱う
+        return row[0] if row else None
+
+    def _write(self, sql, params):
+        with self._write_lock:
+            try:
+                self._writer.execute(sql, params)
+                self._writes += 1
+                if self._writes % SHARED_PRUNE_INTERVAL == 0:
+                    self._writer.execute("DELETE FROM kv WHERE expires_at <= ?", (time.time(),))
+            except sqlite3.OperationalError as e:
+                print(f"Shared store write failed: {e}")
+
+    async def _set(self, key, blob, ttl):
+        await run_in_threadpool(self._write, "INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)", (key, blob, time.time() + ttl))
+
+    async def _delete(self, key):
+        await run_in_threadpool(self._write, "DELETE FROM kv WHERE key = ?", (key,))
+
+    async def close(self):
+        self._reader.close()
+        self._writer.close()
+
+
+class RedisStore(SharedStore):
+    """
+    Redis (または Redis 互換のサーバー) を使う共有ストア。複数ホストにまたがる場合に使う。
+    redis パッケージがインストールされている必要がある。
+    """
+    def __init__(self, url):
+        super().__init__()
+        import redis.asyncio  # 任意の依存パッケージ
+        self._redis = redis.asyncio.from_url(url)
+        self._errors = (redis.exceptions.RedisError, OSError)
+
+    async def _get(self, key):
+        try:
+            return await self._redis.get(key)
+        except self._errors:
+            return None
+
+    async def _set(self, key, blob, ttl):
+        try:
+            await self._redis.set(key, blob, px=max(1, int(ttl * 1000)))
+        except self._errors as e:
+            print(f"Shared store write failed: {e}")
+
+    async def _delete(self, key):
+        try:
+            await self._redis.delete(key)
+        except self._errors:
+            pass
+
+    async def close(self):
+        close = getattr(self._redis, "aclose", None) or self._redis.close  # redis-py 5.0.1 より前は close のみ
+        await close()
+
+
+def createSharedStore(url):
+    if not url:
+        return None
+    if url.startswith("sqlite:///"):
+        return SQLiteStore(url[len("sqlite:///"):])
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisStore(url)
+    raise ValueError(f"Unsupported SHARED_STORE_URL: {url}")
+
+shared_store = None  # lifespan で作成する
+
+async def sharedGet(key):
+    """共有ストアの値を (値, 残りの有効期間, 残りのstale期間) で返す。共有ストアが無効か値が無ければ None。"""
+    if shared_store is None:
+        return None
+    entry = await shared_store.get(key)
+    if entry is None:
+        return None
+    data, expires, stale_until = entry
+    now = time.time()
+    return data, expires - now, stale_until - max(expires, now)
+
+def sharedPublish(key, data, ttl, stale=CACHE_STALE_TIME):
+    """共有ストアへ値 (バイト列) を書き込む (完了は待たない)"""
+    if shared_store is not None:
+        spawn_background(shared_store.set(key, data, ttl, stale))
+
+def sharedPublishJSON(key, value, ttl, stale=CACHE_STALE_TIME):
+    """共有ストアが有効な場合だけ value をJSONにして書き込む。無効ならエンコードもしない。"""
+    if shared_store is not None:
+        sharedPublish(key, encodeJSON(value), ttl, stale)
+
+def sharedInvalidate(key):
+    if shared_store is not None:
+        spawn_background(shared_store.delete(key))
+
+def cacheKey(path, category):
+    """クエリの順序に依存しないキャッシュキー"""
+    parts = urllib.parse.urlsplit(path)
+    query = urllib.parse.urlencode(sorted(urllib.parse.parse_qsl(parts.query, keep_blank_values=True)))
+    return f"{category}:{parts.path}" + (f"?{query}" if query else "")
+
+def pickFields(data, fields):
+    return {key: data[key] for key in fields if key in data}
+
+def trimResponse(category, data):
+    """デコード済みの応答を、そのカテゴリの整形処理が使う項目だけの同じ形の値にする (共有ストアにはこれを書き込む)"""
+    trim = RESPONSE_PROJECTIONS.get(category, (None, None))[0]
+    return trim(data) if trim is not None else data
+
+def buildResponse(category, trimmed):
+    """trimResponse の結果から、キャッシュして呼び出し側へ返す値 (__slots__ のレコードなど) を作る"""
+    build = RESPONSE_PROJECTIONS.get(category, (None, None))[1]
+    return build(trimmed) if build is not None else trimmed
+
+def projectedSize(value, raw):
+    return getattr(value, "size", None) or len(raw)
+
+async def _fetchAndCache(key, path, api_urls, category):
+    res = await requestAPI(path, api_urls)
+    trimmed = trimResponse(category, res.data)
+    value = buildResponse(category, trimmed)
+    response_cache.set(key, value, CACHE_TTL[category], projectedSize(value, res.raw))
+    sharedPublishJSON(key, trimmed, CACHE_TTL[category])
+    return value
+
+async def _loadShared(key, path, api_urls, category):
+    """プロセス内のキャッシュに無い値を共有ストアから取り込む。無ければ上流から取得する。"""
+    shared = await sharedGet(key)
+    if shared is None:
+        return await _fetchAndCache(key, path, api_urls, category)
+    data, ttl, stale = shared
+    value = buildResponse(category, decodeJSON(data))
+    response_cache.set(key, value, max(ttl, 0), projectedSize(value, data), stale=stale)
+    if ttl <= 0:
+        spawn_background(_refreshCache(key, path, api_urls, category))
+    return value
+
+async def _refreshCache(key, path, api_urls, category):
+    try:
+        await upstream_flight.do(key, lambda: _fetchAndCache(key, path, api_urls, category))
+    except (APITimeoutError, ValueError, KeyError, TypeError):
+        pass  # 取得できなければ古い値のまま
+
+async def cachedRequestAPI(path, api_urls, category=None):
+    """
+    requestAPI のキャッシュ付き版。期限切れ (stale) の値はそのまま返し、裏で再取得する。
+    同じパスへの同時要求は upstream_flight で1回の取得にまとめる。
+    キャッシュするのは RESPONSE_PROJECTIONS で必要な項目だけを取り出して作った値で、呼び出し側はそれをそのまま使う。
+    項目が足りない応答は KeyError / TypeError になり、キャッシュしない。
+    """
+    category = category or api_urls.category
+    key = cacheKey(path, category)
+    entry = response_cache.get(key)
+    if entry is not None:
+        value, fresh = entry
+        if not fresh:
+            spawn_background(_refreshCache(key, path, api_urls, category))
+        return value
+
+    return await upstream_flight.do(key, lambda: _loadShared(key, path, api_urls, category))
+
+
+VIDEO_FIELDS = ("videoId", "title", "descriptionHtml", "lengthSeconds", "authorId", "author", "viewCount", "likeCount", "subCountText")
+RECOMMENDED_VIDEO_FIELDS = ("videoId", "title", "authorId", "author", "lengthSeconds", "viewCountText")
+
+def trimVideo(t):
+    """/videos の応答から VideoRecord が使う項目だけを残す"""
+    trimmed = pickFields(t, VIDEO_FIELDS)
+    trimmed["authorThumbnails"] = t["authorThumbnails"][-1:]
+    trimmed["formatStreams"] = [{"url": i["url"]} for i in t["formatStreams"]]
+    trimmed["recommendedVideos"] = [pickFields(i, RECOMMENDED_VIDEO_FIELDS) for i in t.get('recommendedvideo') or t.get('recommendedVideos') or []]
+    return trimmed
+
+
+class RecommendedVideo:
+    """関連動画1件のうち、動画ページで表示する項目"""
+    __slots__ = ("video_id", "title", "author_id", "author", "length_text", "view_count_text")
+
+    def __init__(self, i):
+        self.video_id = i["videoId"]
+        self.title = i["title"]
+        self.author_id = i["authorId"]
+        self.author = i["author"]
+        self.length_text = str(datetime.timedelta(seconds=i["lengthSeconds"]))
+        self.view_count_text = i["viewCountText"]
+
+    def asDict(self):
+        return {"video_id": self.video_id, "title": self.title, "author_id": self.author_id, "author": self.author, "length_text": self.length_text, "view_count_text": self.view_count_text}
+
+
+class VideoRecord:
+    """
+    /videos の応答のうち getVideoData と formatVideoSummary が使う項目だけを持つ。
+    adaptiveFormats などの大きな項目は保持しない。
+    """
+    __slots__ = ("video_id", "title", "description_html", "length_text", "author_id", "author", "author_thumbnail_url",
+                 "view_count", "like_count", "subscribers_count", "video_urls", "recommended", "size")
+
+    def __init__(self, t):
+        self.video_id = t.get("videoId")
+        self.title = t["title"]
+        self.description_html = t["descriptionHtml"].replace("\n", "<br>")
+        self.length_text = str(datetime.timedelta(seconds=t["lengthSeconds"]))
+        self.author_id = t["authorId"]
+        self.author = t["author"]
+        self.author_thumbnail_url = t["authorThumbnails"][-1]["url"]
+        self.view_count = t["viewCount"]
+        self.like_count = t["likeCount"]
+        self.subscribers_count = t["subCountText"]
+        # InvidiousのフォールバックURL
+        self.video_urls = tuple(reversed([i["url"] for i in t["formatStreams"]]))[:2]
+        self.recommended = tuple(RecommendedVideo(i) for i in t.get('recommendedvideo') or t.get('recommendedVideos') or [])
+        self.size = len(self.description_html) + sum(len(url) for url in self.video_urls) + sum(len(r.title) + len(r.author) for r in self.recommended)
+
+
 async def getVideoData(videoid):
-    t_text = await run_in_threadpool(requestAPI, f"/videos/{urllib.parse.quote(videoid)}", invidious_api.video)
-    t = json.loads(t_text)
-    recommended_videos = t.get('recommendedvideo') or t.get('recommendedVideos') or []
-    
-    # InvidiousのフォールバックURL
-    fallback_videourls = list(reversed([i["url"] for i in t["formatStreams"]]))[:2]
+    v = await cachedRequestAPI(f"/videos/{urllib.parse.quote(videoid)}", invidious_api.video)
     
     # データを整理して返す
     return [{
-        'video_urls': fallback_videourls, 
-        'description_html': t["descriptionHtml"].replace("\n", "<br>"), 'title': t["title"],
-        'length_text': str(datetime.timedelta(seconds=t["lengthSeconds"])), 'author_id': t["authorId"], 'author': t["author"], 'author_thumbnails_url': t["authorThumbnails"][-1]["url"], 'view_count': t["viewCount"], 'like_count': t["likeCount"], 'subscribers_count': t["subCountText"]
-    }, [
-        {"video_id": i["videoId"], "title": i["title"], "author_id": i["authorId"], "author": i["author"], "length_text": str(datetime.timedelta(seconds=i["lengthSeconds"])), "view_count_text": i["viewCountText"]}
-        for i in recommended_videos
-    ]]
+        'video_urls': list(v.video_urls), 
+        'description_html': v.description_html, 'title': v.title,
+        'length_text': v.length_text, 'author_id': v.author_id, 'author': v.author, 'author_thumbnails_url': v.author_thumbnail_url, 'view_count': v.view_count, 'like_count': v.like_count, 'subscribers_count': v.subscribers_count
+    }, [i.asDict() for i in v.recommended]]
     
+def formatVideoSummary(v, videoid=None):
+    """動画情報のうち一覧表示に必要な項目だけを取り出す"""
+    return {
+        "video_id": v.video_id or videoid, "title": v.title, "author_id": v.author_id, "author": v.author,
+        "length_text": v.length_text, "view_count": v.view_count, "like_count": v.like_count
+    }
+
+async def getVideoSummary(videoid):
+    """/watch と同じキャッシュを使って動画の概要を取得する"""
+    return formatVideoSummary(await cachedRequestAPI(f"/videos/{urllib.parse.quote(videoid)}", invidious_api.video), videoid)
+
+async def getVideoSummaries(videoids, concurrency=BATCH_CONCURRENCY):
+    """
+    複数の動画の概要を並行して取得し、取得できた順に (動画ID, 概要, エラー) を返す。
+    失敗した動画は概要が None になり、ほかの動画の取得は続ける。
+    """
+    slots = asyncio.Semaphore(concurrency)
+
+    async def fetch(videoid):
+        async with slots:
+            try:
+                return videoid, await getVideoSummary(videoid), None
+            except APITimeoutError:
+                return videoid, None, "unavailable"
+            except (ValueError, KeyError, TypeError):
+                return videoid, None, "invalid_response"
+
+    tasks = [asyncio.ensure_future(fetch(videoid)) for videoid in videoids]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+
 async def getSearchData(q, page):
-    datas_text = await run_in_threadpool(requestAPI, f"/search?q={urllib.parse.quote(q)}&page={page}&hl=jp", invidious_api.search)
-    datas_dict = json.loads(datas_text)
-    return [formatSearchData(data_dict) for data_dict in datas_dict]
+    return list(await cachedRequestAPI(f"/search?q={urllib.parse.quote(q)}&page={page}&hl=jp", invidious_api.search))
+
+SEARCH_ITEM_FIELDS = ("type", "title", "videoId", "author", "authorId", "publishedText", "lengthSeconds", "viewCountText", "playlistId", "playlistThumbnail", "videoCount")
+
+def trimSearchItem(data_dict):
+    """検索結果1件から formatSearchData が使う項目だけを残す"""
+    trimmed = pickFields(data_dict, SEARCH_ITEM_FIELDS)
+    if "authorThumbnails" in data_dict:
+        trimmed["authorThumbnails"] = data_dict["authorThumbnails"][-1:]
+    return trimmed
+
+def trimSearchResults(datas_dict):
+    return [trimSearchItem(data_dict) for data_dict in datas_dict]
+
+def trimTrendingResults(datas_dict):
+    return [trimSearchItem(data_dict) for data_dict in datas_dict if data_dict.get("type") == "video"]
+
+def formatSearchResults(datas_dict):
+    return tuple(formatSearchData(data_dict) for data_dict in datas_dict)
+
+def formatTrendingData(datas_dict):
+    return tuple(formatSearchData(data_dict) for data_dict in datas_dict if data_dict.get("type") == "video")
 
 async def getTrendingData(region: str):
     path = f"/trending?region={region}&hl=jp"
-    datas_text = await run_in_threadpool(requestAPI, path, invidious_api.search)
-    datas_dict = json.loads(datas_text)
-    return [formatSearchData(data_dict) for data_dict in datas_dict if data_dict.get("type") == "video"]
+    return list(await cachedRequestAPI(path, invidious_api.search, 'trending'))
+
+
+class TrendingSnapshot:
+    """あるリージョンの急上昇の取得結果。作成後は変更せず、更新時は新しいスナップショットに置き換える。"""
+    __slots__ = ("region", "videos", "fetched_at")
+
+    def __init__(self, region, videos):
+        self.region = region
+        self.videos = tuple(videos)
+        self.fetched_at = time.time()
+
+    @property
+    def age(self):
+        return time.time() - self.fetched_at
+
+
+trending_snapshots = {}  # リージョン -> TrendingSnapshot
+
+async def refreshTrending(region):
+    """急上昇を取得してスナップショットを置き換える。失敗した場合は古いスナップショットを残して False を返す。"""
+    try:
+        # ほかのワーカーが取得したばかりならそれを使う
+        shared = await sharedGet(f"trending:{region}")
+        if shared is not None and shared[1] > 0:
+            videos = formatTrendingData(decodeJSON(shared[0]))
+        else:
+            res = await requestAPI(f"/trending?region={region}&hl=jp", invidious_api.search)
+            trimmed = trimTrendingResults(res.data)
+            videos = formatTrendingData(trimmed)
+            sharedPublishJSON(f"trending:{region}", trimmed, TRENDING_REFRESH_INTERVAL * (1 - TRENDING_REFRESH_JITTER), stale=0)
+    except (APITimeoutError, ValueError, KeyError, TypeError, AttributeError) as e:
+        print(f"Failed to refresh trending for {region}: {e!r}")
+        return False
+    trending_snapshots[region] = TrendingSnapshot(region, videos)
+    return True
+
+async def trending_refresh_loop(region):
+    while True:
+        try:
+            ok = await refreshTrending(region)
+        except Exception as e:
+            print(f"Failed to refresh trending for {region}: {e!r}")
+            ok = False
+        interval = TRENDING_REFRESH_INTERVAL if ok else TRENDING_RETRY_INTERVAL
+        await asyncio.sleep(interval * random.uniform(1 - TRENDING_REFRESH_JITTER, 1 + TRENDING_REFRESH_JITTER))
+
+def trimChannel(t):
+    """/channels の応答のうち getChannelData が使う項目だけを残す。欠けている項目は getChannelData が既定値で補う。"""
+    keep = {key: t[key] for key in ("author", "descriptionHtml", "subCount", "tags") if key in t}
+    if t.get("authorThumbnails"):
+        keep["authorThumbnails"] = t["authorThumbnails"][-1:]
+    if t.get("authorBanners"):
+        keep["authorBanners"] = t["authorBanners"][:1]
+    keep["latestVideos"] = [
+        {key: i[key] for key in ("title", "videoId", "publishedText", "viewCountText", "lengthSeconds") if key in i}
+        for i in t.get('latestvideo') or t.get('latestVideos') or []
+    ]
+    return keep
 
 async def getChannelData(channelid):
     t = {}
     try:
         # 外部APIを呼び出す
-        t_text = await run_in_threadpool(requestAPI, f"/channels/{urllib.parse.quote(channelid)}", invidious_api.channel)
-        t = json.loads(t_text)
+        path = f"/channels/{urllib.parse.quote(channelid)}"
+        t = await cachedRequestAPI(path, invidious_api.channel)
 
         # 最新動画がない場合、APIデータは無効とみなし、tをリセットして次の処理に進む
         latest_videos_check = t.get('latestvideo') or t.get('latestVideos')
         if not latest_videos_check:
             print(f"API returned no latest videos for channel {channelid}. Treating as failure.")
+            response_cache.invalidate(cacheKey(path, 'channel'))
+            sharedInvalidate(cacheKey(path, 'channel'))
             t = {}
 
     except APITimeoutError:
@@ -199,80 +1482,369 @@ async def getChannelData(channelid):
     author_thumbnails = t.get("authorThumbnails", [])
     author_icon_url = author_thumbnails[-1].get("url", failed) if author_thumbnails else failed
 
-    # チャンネルバナーの安全な取得とURLエンコード
-    author_banner_url = ''
-    author_banners = t.get('authorBanners', [])
-    if author_banners and author_banners[0].get("url"):
-        author_banner_url = urllib.parse.quote(author_banners[0]["url"], safe="-_.~/:")
-    
-    
-    # データを整理して返す (tが空でもすべてのキーが存在することを保証)
-    return [[
-        {"type":"video", "title": i.get("title", failed), "id": i.get("videoId", failed), "author": t.get("author", failed), "published": i.get("publishedText", failed), "view_count_text": i.get('viewCountText', failed), "length_str": str(datetime.timedelta(seconds=i.get("lengthSeconds", 0)))}
-        for i in latest_videos
-    ], {
-        "channel_name": t.get("author", "チャンネル情報取得失敗"), 
-        "channel_icon": author_icon_url, 
-        "channel_profile": t.get("descriptionHtml", "このチャンネルのプロフィール情報は見つかりませんでした。"),
-        "author_banner": author_banner_url,
-        "subscribers_count": t.get("subCount", failed), 
-        "tags": t.get("tags", [])
-    }]
+    # チャンネルバナーの安全な取得とURLエンコード
+    author_banner_url = ''
+    author_banners = t.get('authorBanners', [])
+    if author_banners and author_banners[0].get("url"):
+        author_banner_url = urllib.parse.quote(author_banners[0]["url"], safe="-_.~/:")
+    
+    
+    # データを整理して返す (tが空でもすべてのキーが存在することを保証)
+    return [[
+        {"type":"video", "title": i.get("title", failed), "id": i.get("videoId", failed), "author": t.get("author", failed), "published": i.get("publishedText", failed), "view_count_text": i.get('viewCountText', failed), "length_str": str(datetime.timedelta(seconds=i.get("lengthSeconds", 0)))}
+        for i in latest_videos
+    ], {
+        "channel_name": t.get("author", "チャンネル情報取得失敗"), 
+        "channel_icon": author_icon_url, 
+        "channel_profile": t.get("descriptionHtml", "このチャンネルのプロフィール情報は見つかりませんでした。"),
+        "author_banner": author_banner_url,
+        "subscribers_count": t.get("subCount", failed), 
+        "tags": t.get("tags", [])
+    }]
+
+async def getPlaylistData(listid, page):
+    full = playlist_cache.get(listid)
+    if full is not None:
+        index, fresh = full
+        if not fresh:
+            spawn_background(_refreshPlaylist(listid))
+        # 全体を取得済みならページもそこから返す (PLAYLIST_MAX_PAGES で打ち切った先のページと 1 未満のページは上流から取得する)
+        if int(page) >= 1 and (index.complete or (int(page) - 1) * index.page_size < len(index)):
+            return index.page(int(page))
+    return formatPlaylistVideos(await getPlaylistPage(listid, page))
+
+async def getPlaylistPage(listid, page):
+    return await cachedRequestAPI(f"/playlists/{urllib.parse.quote(listid)}?page={urllib.parse.quote(str(page))}", invidious_api.playlist)
+
+def formatPlaylistVideos(t):
+    return [dict(i, type="video") for i in t.videos]
+
+
+def trimPlaylist(t):
+    """/playlists の1ページから PlaylistPage が使う項目だけを残す"""
+    return {"title": t.get("title", ""), "videoCount": t.get("videoCount"), "videos": [pickFields(i, ("title", "videoId", "authorId", "author")) for i in t["videos"]]}
+
+
+class PlaylistPage:
+    """/playlists の1ページのうち、一覧表示と PlaylistIndex の組み立てに使う項目"""
+    __slots__ = ("title", "video_count", "videos", "size")
+
+    def __init__(self, t):
+        self.title = t.get("title", "")
+        self.video_count = int(t.get("videoCount") or 0)
+        self.videos = tuple({"title": i["title"], "id": i["videoId"], "authorId": i["authorId"], "author": i["author"]} for i in t["videos"])
+        self.size = sum(len(i["title"]) + len(i["id"]) + len(i["authorId"]) + len(i["author"]) for i in self.videos)
+
+
+# キャッシュのカテゴリ -> (必要な項目だけを残す関数, キャッシュする値を作る関数) (cachedRequestAPI が使う)
+RESPONSE_PROJECTIONS = {
+    'video': (trimVideo, VideoRecord),
+    'search': (trimSearchResults, formatSearchResults),
+    'trending': (trimTrendingResults, formatTrendingData),
+    'channel': (trimChannel, None),
+    'playlist': (trimPlaylist, PlaylistPage),
+}
+
+
+class PlaylistIndex:
+    """
+    プレイリスト全体の動画一覧。動画ごとの辞書ではなく項目ごとのタプルで持ち、メモリを抑える。
+    page() は上流と同じページ分けで getPlaylistData と同じ形式の一覧を返す。
+    """
+    __slots__ = ("title", "page_size", "video_ids", "titles", "author_ids", "authors", "complete", "size")
+
+    def __init__(self, title, page_size, videos, complete):
+        self.title = title
+        self.page_size = page_size
+        self.video_ids = tuple(i["id"] for i in videos)
+        self.titles = tuple(i["title"] for i in videos)
+        self.author_ids = tuple(i["authorId"] for i in videos)
+        self.authors = tuple(i["author"] for i in videos)
+        self.complete = complete
+        self.size = sum(len(self.video_ids[n]) + len(self.titles[n]) + len(self.author_ids[n]) + len(self.authors[n]) for n in range(len(self)))
+
+    def __len__(self):
+        return len(self.video_ids)
+
+    def videos(self, start=0, stop=None):
+        return [
+            {"title": self.titles[n], "id": self.video_ids[n], "authorId": self.author_ids[n], "author": self.authors[n], "type": "video"}
+            for n in range(*slice(start, stop).indices(len(self)))
+        ]
+
+    def page(self, page):
+        start = (page - 1) * self.page_size
+        return self.videos(start, start + self.page_size)
+
+
+playlist_cache = ResponseCache(PLAYLIST_CACHE_MAX_ENTRIES, PLAYLIST_CACHE_MAX_BYTES)
+
+async def _assemblePlaylist(listid):
+    first = await getPlaylistPage(listid, 1)
+    page_size = len(first.videos) or 1
+    needed_pages = max(1, -(-first.video_count // page_size))
+    page_count = min(PLAYLIST_MAX_PAGES, needed_pages)
+    slots = asyncio.Semaphore(PLAYLIST_CONCURRENCY)
+
+    async def fetch(page):
+        async with slots:
+            try:
+                return (await getPlaylistPage(listid, page)).videos
+            except (APITimeoutError, ValueError, KeyError, TypeError):
+                return None
+
+    pages = [first.videos] + await asyncio.gather(*(fetch(page) for page in range(2, page_count + 1)))
+
+    # ページの境界で同じ動画が重複して返ることがあるため、順序を保ったまま取り除く
+    seen = set()
+    videos = []
+    for items in pages:
+        for i in items or ():
+            if i["id"] not in seen:
+                seen.add(i["id"])
+                videos.append(i)
+
+    # PLAYLIST_MAX_PAGES で打ち切った一覧は complete=False で返すが、取り直しても同じなのでキャッシュはする
+    fetched = all(items is not None for items in pages)
+    index = PlaylistIndex(first.title, page_size, videos, complete=fetched and page_count == needed_pages)
+    if fetched:
+        playlist_cache.set(listid, index, CACHE_TTL['playlist'], index.size)
+    return index
+
+async def getFullPlaylist(listid):
+    """
+    プレイリストの全ページを並行して取得し、順序どおりにまとめた PlaylistIndex を返す。
+    取得できなかったページがある場合は、取得できた分だけを返してキャッシュしない。
+    PLAYLIST_MAX_PAGES を超える分は含めず、complete を False にする。
+    """
+    entry = playlist_cache.get(listid)
+    if entry is not None:
+        index, fresh = entry
+        if not fresh:
+            spawn_background(_refreshPlaylist(listid))
+        return index
+    return await upstream_flight.do(f"playlist:{listid}", lambda: _assemblePlaylist(listid))
+
+async def _refreshPlaylist(listid):
+    try:
+        await upstream_flight.do(f"playlist:{listid}", lambda: _assemblePlaylist(listid))
+    except (APITimeoutError, ValueError, KeyError):
+        pass  # 取得できなければ古い一覧のまま
+
+def trimComments(t):
+    """/comments の応答から CommentsPage が使う項目だけを残す"""
+    return {
+        "comments": [dict(pickFields(i, ("author", "authorId", "contentHtml")), authorThumbnails=i["authorThumbnails"][-1:]) for i in t["comments"]],
+        "continuation": t.get("continuation"),
+    }
+
+
+class CommentsPage:
+    """整形済みのコメント1ページ分と、次のページの continuation トークン"""
+    __slots__ = ("comments", "continuation", "size")
+
+    def __init__(self, t):
+        self.comments = tuple(
+            {"author": i["author"], "authoricon": i["authorThumbnails"][-1]["url"], "authorid": i["authorId"], "body": i["contentHtml"].replace("\n", "<br>")}
+            for i in t["comments"]
+        )
+        self.continuation = t.get("continuation") or None
+        self.size = sum(len(c["body"]) + len(c["authoricon"]) + len(c["author"]) for c in self.comments)
+
+
+comments_page_cache = ResponseCache(COMMENTS_PAGE_MAX_ENTRIES, COMMENTS_PAGE_MAX_BYTES)
+
+async def _fetchCommentsPage(key, path):
+    res = await requestAPI(path, invidious_api.comments)
+    trimmed = trimComments(res.data)
+    page = CommentsPage(trimmed)
+    comments_page_cache.set(key, page, CACHE_TTL['comments'], page.size)
+    sharedPublishJSON(key, trimmed, CACHE_TTL['comments'])
+    return page
+
+async def _loadCommentsPage(key, path):
+    shared = await sharedGet(key)
+    if shared is None:
+        return await _fetchCommentsPage(key, path)
+    data, ttl, stale = shared
+    page = CommentsPage(decodeJSON(data))
+    comments_page_cache.set(key, page, max(ttl, 0), page.size, stale=stale)
+    if ttl <= 0:
+        spawn_background(_refreshCommentsPage(key, path))
+    return page
+
+async def _refreshCommentsPage(key, path):
+    try:
+        await upstream_flight.do(key, lambda: _fetchCommentsPage(key, path))
+    except (APITimeoutError, ValueError, KeyError):
+        pass  # 取得できなければ古いページのまま
+
+async def getCommentsData(videoid, continuation=None):
+    """
+    コメントの1ページを CommentsPage で返す。continuation を指定するとその続きのページを返す。
+    ページは (動画ID, continuation) ごとに整形済みの状態でキャッシュし、期限切れなら古いページを返しつつ裏で再取得する。
+    """
+    path = f"/comments/{urllib.parse.quote(videoid)}"
+    if continuation:
+        path += f"?continuation={urllib.parse.quote(continuation)}"
+    key = cacheKey(path, 'comments')
+    entry = comments_page_cache.get(key)
+    if entry is not None:
+        page, fresh = entry
+        if not fresh:
+            spawn_background(_refreshCommentsPage(key, path))
+        return page
+
+    return await upstream_flight.do(key, lambda: _loadCommentsPage(key, path))
+# --- New Helper ---
+
+
+async def fetchStreamFormats(videoid: str) -> dict:
+    """
+    外部APIの /dl/{videoid} を取得する。
+    """
+    res = await http_get(f"{YTDL_API_BASE_URL}{urllib.parse.quote(videoid)}")
+    res.raise_for_status()
+    return decodeJSON(res.content)
+
+
+def get_video_quality_score(f):
+    """画質文字列を比較可能なスコアに変換 (例: 1080p60 > 1080p30 > 720p60)"""
+    quality_str = f.get("quality", "0").lower().replace("p", "").replace("p60", "60").replace("p30", "30").replace("high", "0")
+    try:
+        # フレームレート考慮 (例: 1080p60 > 1080p30)
+        if "60" in quality_str:
+            return int(quality_str.replace("60", "")) * 100 + 60
+        else:
+            return int(quality_str) * 100 + 30
+    except ValueError:
+        return 0
+
+
+class StreamFormatIndex:
+    """
+    /dl/{videoid} のフォーマット一覧を itag・解像度・fps・コーデック・コンテナ・音声ビットレートで引けるようにしたもの。
+    find() は /api/stream_formats で画質を切り替えるときに使う。
+    署名付きURLの expire パラメータから、このインデックスを使ってよい期限 (expires_at) を求める。
+    """
+    EXPIRE_PATTERN = re.compile(r"[?&/]expire[=/](\d+)")
+
+    def __init__(self, data):
+        res_data = data.get("res_data", {})
+        self.title = res_data.get("title", "Video")
+        self.formats = [f for f in res_data.get("formats", []) if f.get("url")]
+        if not self.formats:
+            raise ValueError("External API response is missing video formats.")
+
+        self.by_itag = {f.get("itag"): f for f in self.formats}
+        self.by_resolution = {}
+        for f in self.formats:
+            self.by_resolution.setdefault(self.height(f), []).append(f)
+
+        # 映像+音声 / 映像のみ (画質順) / 音声のみ (音質順)
+        self.muxed = [f for f in self.formats if f.get("vcodec") != "none" and f.get("acodec") != "none"]
+        self.video_only = sorted((f for f in self.formats if f.get("acodec") == "none" and f.get("vcodec") != "none"), key=get_video_quality_score, reverse=True)
+        self.audio_only = sorted((f for f in self.formats if f.get("vcodec") == "none" and f.get("acodec") != "none"), key=self.audio_bitrate, reverse=True)
+
+        expires = [int(m.group(1)) for m in (self.EXPIRE_PATTERN.search(f["url"]) for f in self.formats) if m]
+        self.expires_at = (min(expires) if expires else time.time() + STREAM_INDEX_DEFAULT_TTL) - STREAM_URL_EXPIRY_MARGIN
+
+    @staticmethod
+    def height(f):
+        if f.get("height"):
+            return int(f["height"])
+        m = re.match(r"(\d+)p", f.get("quality", ""))
+        return int(m.group(1)) if m else 0
+
+    @staticmethod
+    def fps(f):
+        if f.get("fps"):
+            return int(f["fps"])
+        return 60 if "p60" in f.get("quality", "") else 30
+
+    @staticmethod
+    def codec(name):
+        return (name or "none").split(".")[0]
+
+    @staticmethod
+    def audio_bitrate(f):
+        # abr が無い場合はファイルサイズをビットレートの代理指標にする
+        return float(f.get("abr") or 0), int(f.get("filesize", 0) or 0)
+
+    def find(self, itag=None, height=None, fps=None, vcodec=None, acodec=None, container=None):
+        """条件に合うフォーマットを返す (None の条件は無視)"""
+        if itag is not None:
+            candidates = [self.by_itag[itag]] if itag in self.by_itag else []
+        elif height is not None:
+            candidates = self.by_resolution.get(height, [])
+        else:
+            candidates = self.formats
+        return [
+            f for f in candidates
+            if (height is None or self.height(f) == height)
+            and (fps is None or self.fps(f) == fps)
+            and (vcodec is None or self.codec(f.get("vcodec")) == vcodec)
+            and (acodec is None or self.codec(f.get("acodec")) == acodec)
+            and (container is None or f.get("ext") == container)
+        ]
+
+    def single_360p(self):
+        # 1. itag 18 を探し、映像と音声の両方があることを確認
+        target_format = next((f for f in self.muxed if f.get("itag") == 18), None)
+        if not target_format:
+            # 2. itag 18 が見つからない場合、"360p" を含み音声付きのものを探す（フォールバック）
+            target_format = next((f for f in self.muxed if "360p" in f.get("quality", "")), None)
+        return target_format
+
+    def high_quality_video(self):
+        # 1080pのストリームを優先し、無ければ利用可能な最高画質 (video_only は画質順)
+        target_1080p_formats = [f for f in self.video_only if "1080" in f.get("quality", "")]
+        if target_1080p_formats:
+            return target_1080p_formats[0]
+        return self.video_only[0] if self.video_only else None
+
+    def high_quality_audio(self):
+        # iPad互換性の高いM4A (AAC) を優先し、無ければ他の最高音質
+        audio_formats_m4a = [f for f in self.audio_only if f.get("ext") == "m4a"]
+        if audio_formats_m4a:
+            return audio_formats_m4a[0]
+        return self.audio_only[0] if self.audio_only else None
 
-async def getPlaylistData(listid, page):
-    t_text = await run_in_threadpool(requestAPI, f"/playlists/{urllib.parse.quote(listid)}?page={urllib.parse.quote(str(page))}", invidious_api.playlist)
-    t = json.loads(t_text)["videos"]
-    return [{"title": i["title"], "id": i["videoId"], "authorId": i["authorId"], "author": i["author"], "type": "video"} for i in t]
-
-async def getCommentsData(videoid):
-    t_text = await run_in_threadpool(requestAPI, f"/comments/{urllib.parse.quote(videoid)}", invidious_api.comments)
-    t = json.loads(t_text)["comments"]
-    return [{"author": i["author"], "authoricon": i["authorThumbnails"][-1]["url"], "authorid": i["authorId"], "body": i["contentHtml"].replace("\n", "<br>")} for i in t]
-# --- New Helper ---
 
+stream_index_cache = ResponseCache(1000, 32 * 1024 * 1024)
 
-def get_360p_single_url(videoid: str) -> str:
+async def getStreamIndex(videoid: str) -> StreamFormatIndex:
+    """
+    動画のフォーマットインデックスを返す。署名付きURLの期限が切れるまでキャッシュし、
+    同じ動画への同時要求は1回の取得にまとめる。
+    """
+    entry = stream_index_cache.get(videoid)
+    if entry is not None:
+        return entry[0]
+
+    async def build():
+        index = StreamFormatIndex(await fetchStreamFormats(videoid))
+        ttl = index.expires_at - time.time()
+        if ttl > 0:
+            stream_index_cache.set(videoid, index, ttl, sum(len(f["url"]) for f in index.formats), stale=0)
+        return index
+
+    return await upstream_flight.do(f"dl:{videoid}", build)
+
+
+async def get_360p_single_url(videoid: str) -> str:
     """
     外部APIから音声付きの360p単一ファイルのURLを抽出して返す (itag 18 優先)。
     """
-    YTDL_API_URL = f"https://pmpmpm.onrender.com/dl/{videoid}"
-    
     try:
-        res = requests.get(
-            YTDL_API_URL, 
-            headers=getRandomUserAgent(), 
-            timeout=max_api_wait_time
-        )
-        res.raise_for_status()
-        data = res.json()
-        
-        formats: List[Dict[str, Any]] = data.get("res_data", {}).get("formats", [])
-        if not formats:
-            raise ValueError("External API response is missing video formats.")
-            
-        # 1. itag 18 を探し、映像と音声の両方があることを確認
-        target_format = next((
-            f for f in formats 
-            if f.get("itag") == 18 and 
-               f.get("vcodec") != "none" and 
-               f.get("acodec") != "none"
-        ), None)
-        
+        target_format = (await getStreamIndex(videoid)).single_360p()
+
         if not target_format:
-            # 2. itag 18 が見つからない場合、"360p" を含み音声付きのものを探す（フォールバック）
-            target_format = next((
-                f for f in formats 
-                if "360p" in f.get("quality", "") and 
-                   f.get("vcodec") != "none" and 
-                   f.get("acodec") != "none"
-            ), None)
-
-        if not target_format or not target_format.get("url"):
             raise ValueError("Could not find a single 360p stream with audio (itag 18 or similar).")
             
         return target_format["url"]
 
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         # ネットワークまたはタイムアウトエラー
         raise APITimeoutError(f"Error connecting to external API: {e}") from e
     except (ValueError, json.JSONDecodeError) as e:
@@ -280,127 +1852,781 @@ def get_360p_single_url(videoid: str) -> str:
         raise ValueError(f"Error processing external stream API response: {e}") from e
 
 
-def fetch_high_quality_streams(videoid: str) -> dict:
+async def fetch_high_quality_streams(videoid: str) -> dict:
     """
     外部APIから動画データを取得し、1080pの動画URL（音声なし）と、
     iPad互換性を考慮した最高音質（M4A/AAC）の音声URLを抽出して返す。
-    
-    前提: requests, json, getRandomUserAgent, max_api_wait_time, APITimeoutError 
-          は外部で定義/インポートされていること。
     """
-    YTDL_API_URL = f"https://pmpmpm.onrender.com/dl/{videoid}"
-    
     try:
-        res = requests.get(
-            YTDL_API_URL, 
-            headers=getRandomUserAgent(), 
-            timeout=max_api_wait_time
-        )
-        res.raise_for_status()
-        data = res.json()
-        
-        formats = data.get("res_data", {}).get("formats", [])
-        if not formats:
-            raise ValueError("External API response is missing video formats.")
-            
-        # 画質文字列を比較可能なスコアに変換
-        def get_video_quality_score(f):
-            quality_str = f.get("quality", "0").lower().replace("p", "").replace("p60", "60").replace("p30", "30").replace("high", "0")
-            try:
-                # フレームレート考慮 (例: 1080p60 > 1080p30)
-                if "60" in quality_str:
-                    return int(quality_str.replace("60", "")) * 100 + 60
-                else:
-                    return int(quality_str) * 100 + 30
-            except ValueError:
-                return 0
-            
-        # 1. 動画ストリーム（音声なし）の抽出とソート (1080p優先)
-        video_formats = [f for f in formats if f.get("acodec") == "none" and f.get("vcodec") != "none"]
-        video_formats.sort(key=get_video_quality_score, reverse=True)
-        
-        high_quality_video_url = None
+        index = await getStreamIndex(videoid)
+        video_format = index.high_quality_video()
+        audio_format = index.high_quality_audio()
         
-        # 1080pのストリームを優先的に探す
-        target_1080p_formats = [f for f in video_formats if "1080" in f.get("quality", "")]
-        
-        if target_1080p_formats:
-            # 1080pが存在すれば、その中で最高の品質を選択（ソート済みのため先頭）
-            high_quality_video_url = target_1080p_formats[0]["url"]
-        elif video_formats:
-            # 1080pがない場合は、利用可能な最高画質を選択
-            high_quality_video_url = video_formats[0]["url"]
-            
-        # 2. 音声ストリーム（映像なし）の抽出と選択 (M4A/AACを優先)
-        
-        # iPad互換性の高いM4Aコンテナ (acodec=aac, ext=m4a) のストリームをフィルタリング
-        # YouTubeの単体音声ストリームは通常この形式
-        audio_formats_m4a = [
-            f for f in formats 
-            if f.get("vcodec") == "none" and 
-               f.get("acodec") != "none" and 
-               f.get("ext") == "m4a"
-        ]
-        
-        high_quality_audio_url = None
-        
-        if audio_formats_m4a:
-            # M4A/AACがあれば、ファイルサイズ（ビットレートの代理指標）でソートし、最高音質を選択
-            audio_formats_m4a.sort(key=lambda x: int(x.get("filesize", 0) or 0), reverse=True)
-            high_quality_audio_url = audio_formats_m4a[0]["url"]
-        else:
-            # M4A/AACがない場合、他の利用可能な最高音質（元のロジック）を選択
-            audio_formats_other = [f for f in formats if f.get("vcodec") == "none" and f.get("acodec") != "none"]
-            audio_formats_other.sort(key=lambda x: int(x.get("filesize", 0) or 0), reverse=True)
-            high_quality_audio_url = audio_formats_other[0]["url"] if audio_formats_other else None
-        
-        if not high_quality_video_url or not high_quality_audio_url:
+        if not video_format or not audio_format:
             raise ValueError("Could not find both high-quality video and audio streams.")
             
         return {
-            "video_url": high_quality_video_url, 
-            "audio_url": high_quality_audio_url,
-            "title": data.get("res_data", {}).get("title", "Video")
+            "video_url": video_format["url"], 
+            "audio_url": audio_format["url"],
+            "title": index.title
         }
 
-    except requests.exceptions.HTTPError as e:
+    except httpx.HTTPStatusError as e:
         raise APITimeoutError(f"External stream API returned HTTP error: {e.response.status_code}") from e
-    except (requests.exceptions.RequestException, ValueError, json.JSONDecodeError) as e:
+    except (httpx.HTTPError, ValueError, json.JSONDecodeError) as e:
         raise APITimeoutError(f"Error processing external stream API response: {e}") from e
         
 # 新規追加: /api/edu から呼び出す外部APIヘルパー関数
 async def fetch_embed_url_from_external_api(videoid: str) -> str:
     """
-    外部ストリームAPIを呼び出し、埋め込みURLを取得する（requestsは同期のためスレッドプールで実行）
+    外部ストリームAPIを呼び出し、埋め込みURLを取得する
     """
     
     target_url = f"{EDU_STREAM_API_BASE_URL}{videoid}"
     
-    def sync_fetch():
-        res = requests.get(
-            target_url, 
-            headers=getRandomUserAgent(), 
-            timeout=max_api_wait_time
-        )
-        res.raise_for_status()
-        data = res.json()
+    res = await http_get(target_url)
+    res.raise_for_status()
+    data = decodeJSON(res.content)
+    
+    embed_url = data.get("url")
+    if not embed_url:
+        raise ValueError("External API response is missing the 'url' field.")
         
-        embed_url = data.get("url")
-        if not embed_url:
-            raise ValueError("External API response is missing the 'url' field.")
-            
-        return embed_url
+    return embed_url
+
+
+class ThumbnailCache:
+    """
+    サムネイル画像の2段キャッシュ。メモリ上のホットキャッシュ (ResponseCache) と、
+    サイズ上限付きのディスクキャッシュ (LRU) を持つ。ディスクI/Oはスレッドプールで行う。
+    """
+    VIDEOID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+    def __init__(self, directory, max_bytes, memory_max_bytes):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.memory = ResponseCache(100000, memory_max_bytes)
+        self.size = 0
+        self._index = None  # ファイル名 -> サイズ (古い順)
+        self._lock = threading.Lock()
+
+    def cacheable(self, videoid):
+        return self.VIDEOID_PATTERN.fullmatch(videoid) is not None
+
+    def _load_index(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        files = []
+        for path in self.directory.glob("*.jpg"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, path.name, stat.st_size))
+        self._index = OrderedDict((name, size) for _, name, size in sorted(files))
+        self.size = sum(self._index.values())
+
+    def _read(self, name):
+        with self._lock:
+            return self._read_locked(name)
+
+    def _write(self, name, content):
+        with self._lock:
+            self._write_locked(name, content)
+
+    def _read_locked(self, name):
+        if self._index is None:
+            self._load_index()
+        if name not in self._index:
+            return None
+        try:
+            content = (self.directory / name).read_bytes()
+        except OSError:
+            self.size -= self._index.pop(name)
+            return None
+        self._index.move_to_end(name)
+        return content
+
+    def _write_locked(self, name, content):
+        if self._index is None:
+            self._load_index()
+        tmp = self.directory / f".{name}.{threading.get_ident()}.tmp"
+        tmp.write_bytes(content)
+        os.replace(tmp, self.directory / name)
+        self.size -= self._index.pop(name, 0)
+        self._index[name] = len(content)
+        self.size += len(content)
+        while self._index and self.size > self.max_bytes:
+            old_name, old_size = self._index.popitem(last=False)
+            self.size -= old_size
+            try:
+                (self.directory / old_name).unlink()
+            except OSError:
+                pass
+
+    async def get(self, videoid):
+        """(content, etag) を返す。キャッシュになければ None。"""
+        entry = self.memory.get(videoid)
+        if entry is not None:
+            return entry[0]
+        content = await run_in_threadpool(self._read, f"{videoid}.jpg")
+        if content is None:
+            return None
+        return self._remember(videoid, content)
+
+    async def put(self, videoid, content):
+        self._remember(videoid, content)
+        try:
+            await run_in_threadpool(self._write, f"{videoid}.jpg", content)
+        except OSError as e:
+            print(f"Failed to write thumbnail cache for {videoid}: {e}")
+
+    def _remember(self, videoid, content):
+        item = (content, '"' + hashlib.blake2b(content, digest_size=12).hexdigest() + '"')
+        self.memory.set(videoid, item, THUMBNAIL_MAX_AGE, len(content), stale=0)
+        return item
+
+
+thumbnail_cache = ThumbnailCache(THUMBNAIL_CACHE_DIR, THUMBNAIL_CACHE_MAX_BYTES, THUMBNAIL_MEMORY_MAX_BYTES)
+
+
+def isProxyableMediaURL(url):
+    parts = urllib.parse.urlsplit(url)
+    return parts.scheme == "https" and (parts.hostname or "").endswith(MEDIA_PROXY_HOSTS)
+
+def proxyEnabled(proxy):
+    return bool(proxy) and proxy.lower() not in ("0", "false", "off")
+
+def proxiedMediaURL(url, proxy):
+    """proxy Cookie が有効なら、googlevideo のURLを /proxy/media 経由のURLに書き換える (テンプレートフィルタ media_url)"""
+    if not proxyEnabled(proxy) or not url or not isProxyableMediaURL(url):
+        return url
+    return "/proxy/media?url=" + urllib.parse.quote(url, safe="")
+
+templates.env.filters["media_url"] = proxiedMediaURL
+
+
+class MediaProxyResponse(StreamingResponse):
+    """
+    上流のレスポンスをチャンク単位でそのまま中継する。クライアントへの送信が終わるまで次のチャンクを
+    読まないため、遅いクライアントには上流側もTCPレベルで待たされる (バックプレッシャー)。
+    転送の成否にかかわらず、最後に上流の接続と同時実行枠を解放する。
+    """
+    def __init__(self, upstream, slots):
+        self.upstream = upstream
+        self.slots = slots
+        headers = {k: v for k, v in upstream.headers.items() if k.lower() in MEDIA_PROXY_RESPONSE_HEADERS}
+        super().__init__(upstream.aiter_raw(MEDIA_PROXY_CHUNK_SIZE), status_code=upstream.status_code, headers=headers)
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.upstream.aclose()
+            self.slots.release()
+            metrics.media_streams -= 1
+
+
+media_proxy_slots = None
+
+def getMediaProxySlots():
+    global media_proxy_slots
+    if media_proxy_slots is None:
+        media_proxy_slots = asyncio.Semaphore(MEDIA_PROXY_MAX_STREAMS)
+    return media_proxy_slots
+
+
+class SuggestIndex:
+    """
+    検索候補のプレフィックスインデックス。キーワードのプレフィックスをたどって (トライと同じ要領で)
+    キャッシュ済みの候補を探す。候補が出尽くしている (SUGGEST_MAX_RESULTS 未満の) プレフィックスが
+    見つかれば、それを絞り込むだけで上流に問い合わせずに答えられる。
+    エントリは TTL で失効し、古い順に追い出される。
+    """
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.prefix_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # キーワード -> (候補, 期限)  (登録順 = 期限順)
+
+    @staticmethod
+    def normalize(keyword):
+        return keyword.lower()
+
+    def _valid(self, key, now):
+        entry = self._entries.get(key)
+        return entry is not None and entry[1] > now
+
+    def lookup(self, keyword):
+        key = self.normalize(keyword)
+        now = time.time()
+        if self._valid(key, now):
+            self.hits += 1
+            return self._entries[key][0]
+        for end in range(len(key) - 1, 0, -1):
+            prefix = key[:end]
+            if self._valid(prefix, now):
+                suggestions = self._entries[prefix][0]
+                if len(suggestions) < SUGGEST_MAX_RESULTS:
+                    self.prefix_hits += 1
+                    return [i for i in suggestions if i.lower().startswith(key)]
+        self.misses += 1
+        return None
+
+    def set(self, keyword, suggestions):
+        key = self.normalize(keyword)
+        self._entries.pop(key, None)
+        self._entries[key] = (suggestions, time.time() + self.ttl)
+        now = time.time()
+        while self._entries:
+            oldest_key, (_, expires) = next(iter(self._entries.items()))
+            if expires > now and len(self._entries) <= self.max_entries:
+                break
+            del self._entries[oldest_key]
+
+
+suggest_index = SuggestIndex(SUGGEST_TTL, SUGGEST_MAX_ENTRIES)
+_suggest_inflight = {}  # 検索ボックスのセッションID (sid) -> (キーワード, 取得タスク)
+
+async def fetchSuggestions(keyword):
+    res = await http_get(SUGGEST_URL + urllib.parse.quote(keyword), timeout=SUGGEST_TIMEOUT)
+    res.raise_for_status()
+    suggestions = [i[0] for i in json.loads(res.text[19:-1])[1]]
+    suggest_index.set(keyword, suggestions)
+    return suggestions
+
+
+async def streamTemplate(name, context):
+    """
+    テンプレートを非同期に生成し、STREAM_FLUSH の位置ごとにまとめて返す。
+    細切れの出力をそのまま送らないよう、区切りまではバッファする。
+    """
+    buffer = []
+    async for chunk in stream_templates.get_template(name).generate_async(context):
+        if chunk == STREAM_FLUSH:
+            if buffer:
+                yield "".join(buffer)
+                buffer = []
+        else:
+            buffer.append(chunk)
+    if buffer:
+        yield "".join(buffer)
+
+
+def acceptedEncoding(accept_encoding):
+    """Accept-Encoding から使う圧縮方式 ("br" / "gzip") を選ぶ。圧縮しない場合は None。"""
+    accepted = {}
+    for item in accept_encoding.lower().split(","):
+        name, _, params = item.partition(";")
+        params = params.strip()
+        try:
+            accepted[name.strip()] = float(params[2:]) if params.startswith("q=") else 1.0
+        except ValueError:
+            accepted[name.strip()] = 0.0
+    for encoding in ("br", "gzip") if brotli is not None else ("gzip",):
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+def isCompressible(content_type):
+    return (content_type or "").split(";")[0].strip().lower() in COMPRESS_TYPES
+
+def compressBody(body, encoding, best=False):
+    if encoding == "br":
+        return brotli.compress(body, quality=11 if best else BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=9 if best else GZIP_LEVEL, mtime=0)
+
+def etagMatches(etag, if_none_match):
+    """If-None-Match の弱い比較。圧縮の途中でCDNが W/ を付けることがあるため W/ の有無は区別しない。"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag.removeprefix("W/") in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+
+class StreamEncoder:
+    """ストリーミングの応答を送る単位ごとに圧縮する。単位ごとに flush するので、送信済みの部分はすぐに展開できる。"""
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == "br":
+            self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        if self.encoding == "br":
+            return self._compressor.process(data) + self._compressor.flush()
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        if self.encoding == "br":
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+class StaticAsset:
+    """静的ファイル1つ分の内容と、圧縮版・ETag・フィンガープリント付きの名前"""
+    __slots__ = ("path", "content", "etag", "fingerprinted_name", "media_type", "encoded")
+
+    def __init__(self, path, name):
+        self.path = path
+        self.content = path.read_bytes()
+        digest = hashlib.blake2b(self.content, digest_size=12).hexdigest()
+        self.etag = f'"{digest}"'
+        directory, slash, filename = name.rpartition("/")
+        stem, dot, suffix = filename.rpartition(".")
+        self.fingerprinted_name = directory + slash + (f"{stem}.{digest[:12]}.{suffix}" if dot else f"{filename}.{digest[:12]}")
+        media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        self.media_type = media_type + "; charset=utf-8" if media_type.startswith("text/") else media_type
+        self.encoded = {}  # 圧縮方式 -> 圧縮した内容
+
+    @property
+    def compressible(self):
+        return isCompressible(self.media_type) and len(self.content) >= COMPRESS_MIN_SIZE
+
+    def body(self, encoding):
+        """(内容, 圧縮方式) を返す。事前に圧縮したファイルが古ければ使わず、メモリ上で圧縮する。"""
+        if encoding is None or not self.compressible:
+            return self.content, None
+        if encoding not in self.encoded:
+            precompressed = self.path.with_name(self.path.name + (".br" if encoding == "br" else ".gz"))
+            try:
+                if precompressed.stat().st_mtime >= self.path.stat().st_mtime:
+                    self.encoded[encoding] = precompressed.read_bytes()
+            except OSError:
+                pass
+            if encoding not in self.encoded:
+                self.encoded[encoding] = compressBody(self.content, encoding, best=True)
+        return self.encoded[encoding], encoding
+
+
+class StaticAssets:
+    """
+    static/ のファイルを配信する (ASGIアプリ)。テンプレートでは static_url('style.css') で
+    内容のハッシュを含むURL (/static/style.<hash>.css) を使い、ブラウザとCDNに immutable として長期間キャッシュさせる。
+    ハッシュの無いURLは STATIC_REVALIDATE_MAX_AGE だけキャッシュさせ、その後は ETag で再検証させる。
+    ファイルは最初に使うときに読み込むので、起動後に変更した場合は再起動する。
+    """
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self._assets = None         # 名前 -> StaticAsset
+        self._fingerprinted = None  # フィンガープリント付きの名前 -> StaticAsset
+
+    def assets(self):
+        if self._assets is None:
+            assets = {}
+            for path in sorted(self.directory.rglob("*")):
+                if path.is_file() and path.suffix not in (".gz", ".br"):
+                    name = path.relative_to(self.directory).as_posix()
+                    assets[name] = StaticAsset(path, name)
+            self._fingerprinted = {asset.fingerprinted_name: asset for asset in assets.values()}
+            self._assets = assets
+        return self._assets
+
+    def url(self, name):
+        """テンプレート関数 static_url。フィンガープリント付きのURLを返す。"""
+        asset = self.assets().get(name)
+        return "/static/" + (asset.fingerprinted_name if asset is not None else name)
+
+    def precompress(self):
+        """gzip と brotli で最高レベルに圧縮したファイル (style.css.gz など) を書き出す (python -m app.precompile)"""
+        written = []
+        for asset in self.assets().values():
+            if not asset.compressible:
+                continue
+            for encoding in ("gzip", "br") if brotli is not None else ("gzip",):
+                target = asset.path.with_name(asset.path.name + (".br" if encoding == "br" else ".gz"))
+                try:
+                    target.write_bytes(compressBody(asset.content, encoding, best=True))
+                except OSError as e:
+                    print(f"Failed to write {target}: {e}")
+                    continue
+                written.append(target)
+        return written
+
+    async def __call__(self, scope, receive, send):
+        if scope["method"] not in ("GET", "HEAD"):
+            return await Response("Method Not Allowed", status_code=405, headers={"Allow": "GET, HEAD"})(scope, receive, send)
+        name = scope["path"][len(scope.get("root_path", "")):].lstrip("/")
+        assets = self.assets()
+        asset = self._fingerprinted.get(name)
+        if asset is not None:
+            cache_control = f"public, max-age={STATIC_MAX_AGE}, immutable"
+        else:
+            asset = assets.get(name)
+            cache_control = f"public, max-age={STATIC_REVALIDATE_MAX_AGE}"
+        if asset is None:
+            return await Response("Not Found", status_code=404)(scope, receive, send)
+
+        request_headers = Headers(scope=scope)
+        headers = {"Cache-Control": cache_control, "ETag": asset.etag}
+        if asset.compressible:
+            headers["Vary"] = "Accept-Encoding"
+        if etagMatches(asset.etag, request_headers.get("if-none-match")):
+            return await Response(status_code=304, headers=headers)(scope, receive, send)
+        body, encoding = asset.body(acceptedEncoding(request_headers.get("accept-encoding", "")))
+        if encoding is not None:
+            headers["Content-Encoding"] = encoding
+        await Response(body, media_type=asset.media_type, headers=headers)(scope, receive, send)
+
+
+static_assets = StaticAssets(BASE_DIR / "static")
+templates.env.globals["static_url"] = static_assets.url
+
+
+async def probeInstance(pool, api):
+    """サーキットが開いているインスタンスへのプローブ。成功すればプールへ復帰させる。"""
+    path = HEALTH_PROBE_PATHS.get(pool.category, '/stats')
+    try:
+        await _fetchAPI(api, path, max_api_wait_time, pool)
+        return True
+    except (httpx.HTTPError, APITimeoutError, Overloaded):
+        # Overloaded: ホストの同時接続数が上限に達している。次の機会にプローブする
+        pool.defer_probe(api)
+        return False
+
+async def health_probe_loop():
+    while True:
+        await asyncio.sleep(HEALTH_PROBE_INTERVAL)
+        try:
+            for pool in invidious_api.pools():
+                for api in pool.due_for_probe():
+                    await probeInstance(pool, api)
+        except Exception as e:
+            # 1回の失敗でループ (このワーカーのプローブ) が止まらないようにする
+            print(f"Health probe failed: {e!r}")
+
+async def shared_sync_loop():
+    while True:
+        await asyncio.sleep(SHARED_SYNC_INTERVAL)
+        try:
+            for pool in invidious_api.pools():
+                await pool.sync(shared_store)
+        except Exception as e:
+            print(f"Failed to sync instance health: {e!r}")
+
+@asynccontextmanager
+async def lifespan(app):
+    global http_client, shared_store
+    http_client = create_http_client()
+    shared_store = createSharedStore(SHARED_STORE_URL)
+    tasks = [asyncio.create_task(health_probe_loop())]
+    tasks += [asyncio.create_task(trending_refresh_loop(region)) for region in TRENDING_REGIONS]
+    if shared_store is not None:
+        tasks.append(asyncio.create_task(shared_sync_loop()))
+    try:
+        yield
+    finally:
+        for task in tasks:
+            task.cancel()
+        await http_client.aclose()
+        http_client = None
+        if shared_store is not None:
+            await shared_store.close()
+            shared_store = None
+
+
+class MetricsMiddleware:
+    """ルートごとのレイテンシと処理中のリクエスト数を記録する (ASGIミドルウェア)"""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = [500]
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        metrics.requests_in_flight += 1
+        starttime = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            metrics.requests_in_flight -= 1
+            if scope.get("client_disconnected") and status[0] == 500:
+                status[0] = 499  # 応答前にクライアントが切断した
+            route = getattr(scope.get("route"), "path", None)
+            if route is None:
+                route = "/static" if scope["path"].startswith("/static/") else "unmatched"
+            metrics.route_latency.observe(time.perf_counter() - starttime, route, scope["method"], str(status[0]))
+
+
+def routeClass(path):
+    """流量制御で使うルート種別。制御しないルート (静的ファイル・メディア中継・メトリクス) は None。"""
+    if path.startswith(("/static/", "/proxy/media", "/metrics")):
+        return None
+    if path.startswith("/thumbnail"):
+        return 'thumbnail'
+    if path.startswith("/suggest"):
+        return 'suggest'
+    if path.startswith("/api/"):
+        return 'api'
+    return 'page'
+
+route_limiters = {name: AdmissionLimiter(name, *spec) for name, spec in ADMISSION_CLASSES.items()}
+
+class AdmissionMiddleware:
+    """
+    ルート種別ごとに同時処理数を制限する (ASGIミドルウェア)。空きを待ちきれない要求には
+    すぐに503を返す。上流の空きを待つときの優先度と、上流への要求を打ち切る期限もここで決める。
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        kind = routeClass(scope["path"]) if scope["type"] == "http" else None
+        if kind is None:
+            return await self.app(scope, receive, send)
+
+        request_priority.set(ADMISSION_PRIORITY[kind])
+        request_deadline.set(time.time() + REQUEST_DEADLINES[kind])
+        limiter = route_limiters[kind]
+        try:
+            await limiter.acquire()
+        except Overloaded as e:
+            return await overloadedResponse(e)(scope, receive, send)
+        starttime = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.release(time.perf_counter() - starttime)
+
+
+class DisconnectMiddleware:
+    """
+    クライアントが切断したら処理中のハンドラーをキャンセルする (ASGIミドルウェア)。
+    キャンセルはヘッジ要求や合流中の取得にも伝わり、結果を使わない上流への要求をすぐに打ち切る。
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        messages = asyncio.Queue()
+        completed = False
+
+        async def send_tracking(message):
+            nonlocal completed
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                completed = True
+            await send(message)
+
+        handler = asyncio.ensure_future(self.app(scope, messages.get, send_tracking))
+
+        async def watch():
+            # 受信したメッセージはそのままハンドラーへ渡し、切断だけを見張る
+            while True:
+                message = await receive()
+                await messages.put(message)
+                if message["type"] == "http.disconnect":
+                    if not completed:
+                        scope["client_disconnected"] = True
+                        handler.cancel()
+                    return
+
+        watcher = asyncio.ensure_future(watch())
+        try:
+            await asyncio.wait({handler})
+        finally:
+            watcher.cancel()
+            handler.cancel()
+        if handler.cancelled():
+            metrics.cancelled_requests.inc(getattr(scope.get("route"), "path", "unmatched"))
+            return
+        handler.result()
+
+
+def pageCacheControl(route, request_headers):
+    """PAGE_MAX_AGE のルートの Cache-Control。Cookie で表示が変わるため、Cookie 付きの要求には共有キャッシュを許可しない。"""
+    max_age = PAGE_MAX_AGE.get(route)
+    if max_age is None:
+        return None
+    if "cookie" in request_headers:
+        return f"private, max-age={max_age}"
+    return f"public, max-age={max_age}, stale-while-revalidate={PAGE_STALE_WHILE_REVALIDATE}"
+
+
+class HTTPCacheMiddleware:
+    """
+    ページの応答に Cache-Control と ETag を付け、If-None-Match が一致すれば本文の代わりに304を返す。
+    本文は Accept-Encoding に応じて brotli か gzip で圧縮する (ASGIミドルウェア)。
+    ストリーミングの応答 (/watch など) には ETag を付けず、送る単位ごとに圧縮して先に送る部分を遅らせない。
+    静的ファイルは StaticAssets が同じことを行う。
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in ("GET", "HEAD") or scope["path"].startswith("/static/"):
+            return await self.app(scope, receive, send)
+
+        request_headers = Headers(scope=scope)
+        start = None
+        encoder = None
+
+        async def send_cached(message):
+            nonlocal start, encoder
+            if message["type"] == "http.response.start":
+                start = message  # 本文の最初の部分を見てからヘッダーを決める
+                return
+            if message["type"] != "http.response.body":
+                return await send(message)
+            if start is None:
+                if encoder is not None:
+                    body = encoder.compress(message.get("body", b""))
+                    if not message.get("more_body", False):
+                        body += encoder.finish()
+                    message = dict(message, body=body)
+                return await send(message)
+
+            headers = MutableHeaders(raw=list(start["headers"]))
+            status = start["status"]
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            response_start, start = start, None
+
+            if status == 200 and "cache-control" not in headers and "set-cookie" not in headers:
+                cache_control = pageCacheControl(getattr(scope.get("route"), "path", None), request_headers)
+                if cache_control is not None:
+                    headers["Cache-Control"] = cache_control
+                    headers.add_vary_header("Cookie")
+
+            compressible = isCompressible(headers.get("content-type")) and "content-encoding" not in headers
+            if scope["method"] == "HEAD" or status != 200 or not compressible:
+                return await send_all(dict(response_start, headers=headers.raw), message)
+
+            if more_body or len(body) >= COMPRESS_MIN_SIZE:
+                headers.add_vary_header("Accept-Encoding")
+            if not more_body:
+                if "etag" not in headers:
+                    headers["ETag"] = 'W/"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+                if etagMatches(headers["etag"], request_headers.get("if-none-match")):
+                    for name in ("content-length", "content-type"):
+                        del headers[name]
+                    return await send_all(dict(response_start, status=304, headers=headers.raw), {"type": "http.response.body", "body": b""})
+                if len(body) < COMPRESS_MIN_SIZE:
+                    return await send_all(dict(response_start, headers=headers.raw), message)
+
+            encoding = acceptedEncoding(request_headers.get("accept-encoding", ""))
+            if encoding is None:
+                return await send_all(dict(response_start, headers=headers.raw), message)
+            headers["Content-Encoding"] = encoding
+            if more_body:
+                del headers["content-length"]
+                encoder = StreamEncoder(encoding)
+                body = encoder.compress(body)
+            else:
+                body = compressBody(body, encoding)
+                headers["Content-Length"] = str(len(body))
+            await send_all(dict(response_start, headers=headers.raw), dict(message, body=body))
+
+        async def send_all(*messages):
+            for message in messages:
+                await send(message)
 
-    return await run_in_threadpool(sync_fetch)
+        await self.app(scope, receive, send_cached)
+
+
+def overloadedResponse(e):
+    return Response("Server is busy. Please retry shortly.", status_code=503, headers={"Retry-After": str(e.retry_after)})
+
+
+def registerMetricCallbacks():
+    from anyio import to_thread
+
+    def threadpool():
+        limiter = to_thread.current_default_thread_limiter()
+        yield ("busy",), limiter.borrowed_tokens
+        yield ("queued",), limiter.statistics().tasks_waiting
+        yield ("size",), limiter.total_tokens
+
+    def cache_stats():
+        yield "response", response_cache.stats()
+        yield "thumbnail_memory", thumbnail_cache.memory.stats()
+        yield "stream_index", stream_index_cache.stats()
+        yield "comments_page", comments_page_cache.stats()
+        yield "playlist", playlist_cache.stats()
+
+    def cache_lookups():
+        for name, stats in cache_stats():
+            yield (name, "hit"), stats["hits"]
+            yield (name, "stale_hit"), stats["stale_hits"]
+            yield (name, "miss"), stats["misses"]
+        if shared_store is not None:
+            yield ("shared", "hit"), shared_store.hits
+            yield ("shared", "miss"), shared_store.misses
+        yield ("suggest", "hit"), suggest_index.hits
+        yield ("suggest", "prefix_hit"), suggest_index.prefix_hits
+        yield ("suggest", "miss"), suggest_index.misses
+
+    def cache_hit_ratio():
+        for name, stats in cache_stats():
+            yield (name,), stats["hit_ratio"]
+        lookups = suggest_index.hits + suggest_index.prefix_hits + suggest_index.misses
+        yield ("suggest",), (suggest_index.hits + suggest_index.prefix_hits) / lookups if lookups else 0.0
+        if shared_store is not None:
+            yield ("shared",), shared_store.stats()["hit_ratio"]
+
+    def instance_health(attr):
+        def collect():
+            for pool in invidious_api.pools():
+                for url, health in pool.health.items():
+                    value = getattr(health, attr)
+                    if value is not None:
+                        yield (pool.category, url), float(value)
+        return collect
+
+    def limiters():
+        # googlevideo のようにホストが無数にある上流は upstreamLabel でまとめる
+        totals = {}
+        for limiter in list(route_limiters.values()) + list(_host_limits.values()):
+            total = totals.setdefault(limiter.name, [0, 0, 0])
+            total[0] += limiter.active
+            total[1] += len(limiter._waiters)
+            total[2] += limiter.rejected
+        for name, rejected in _evicted_rejections.items():
+            totals.setdefault(name, [0, 0, 0])[2] += rejected
+        return totals
+
+    metrics.callback("yuzutube_admission_slots", "Admission limiter usage per route class or upstream host (active and queued).", ("limiter", "state"),
+                     lambda: [((name, state), total[n]) for name, total in limiters().items() for n, state in enumerate(("active", "queued"))])
+    metrics.callback("yuzutube_admission_rejected_total", "Requests rejected by an admission limiter.", ("limiter",),
+                     lambda: [((name,), total[2]) for name, total in limiters().items()], kind="counter")
+    metrics.callback("yuzutube_http_requests_in_flight", "Requests currently being handled.", (), lambda: [((), metrics.requests_in_flight)])
+    metrics.callback("yuzutube_threadpool_threads", "Starlette threadpool usage (busy threads, queued tasks and size).", ("state",), threadpool)
+    metrics.callback("yuzutube_media_proxy_streams", "Media streams currently being proxied.", (), lambda: [((), metrics.media_streams)])
+    metrics.callback("yuzutube_cache_lookups_total", "Cache lookups per cache and result.", ("cache", "result"), cache_lookups, kind="counter")
+    metrics.callback("yuzutube_cache_hit_ratio", "Cache hit ratio (hits and stale hits over all lookups).", ("cache",), cache_hit_ratio)
+    metrics.callback("yuzutube_upstream_circuit_open", "1 if the circuit of an Invidious instance is open.", ("category", "upstream"), instance_health("circuit_open"))
+    metrics.callback("yuzutube_upstream_latency_ewma_seconds", "Smoothed latency of an Invidious instance.", ("category", "upstream"), instance_health("latency"))
+    metrics.callback("yuzutube_trending_snapshot_age_seconds", "Age of the trending snapshot per region.", ("region",), lambda: [((s.region,), s.age) for s in list(trending_snapshots.values())])
+    metrics.callback("yuzutube_upstream_error_rate", "Smoothed error rate of an Invidious instance.", ("category", "upstream"), instance_health("error_rate"))
 
 
 # FastAPI Application
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(HTTPCacheMiddleware)
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(DisconnectMiddleware)
+app.add_middleware(MetricsMiddleware)  # 後から追加したものが外側になる (断った要求も記録する)
+
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request: Request, e: Overloaded):
+    return overloadedResponse(e)
 invidious_api = InvidiousAPI() 
+registerMetricCallbacks()
 
 app.mount(
     "/static", 
-    StaticFiles(directory=str(BASE_DIR / "static")), 
+    static_assets, 
     name="static"
 )
 
@@ -411,7 +2637,7 @@ async def get_edu_key_route():
     """
     KahootのYouTubeキーを取得し、JSONで返す
     """
-    key = await run_in_threadpool(getEduKey)
+    key = await getEduKey()
     
     if key:
         return {"key": key}
@@ -428,7 +2654,7 @@ async def embed_high_quality_video(request: Request, videoid: str, proxy: Union[
     """
     try:
         # 外部APIから最高画質のストリームURLを取得
-        stream_data = await run_in_threadpool(fetch_high_quality_streams, videoid)
+        stream_data = await fetch_high_quality_streams(videoid)
         
     except APITimeoutError as e:
         print(f"Error calling external stream API: {e}")
@@ -452,15 +2678,33 @@ async def embed_high_quality_video(request: Request, videoid: str, proxy: Union[
     )
 
 @app.get("/api/stream_360p_url/{videoid}")
-async def get_360p_stream_url_route(videoid: str):
+async def get_360p_stream_url_route(videoid: str, proxy: Union[str] = Cookie(None)):
     """360p音声付き単一ファイルのURLをJSONで返す"""
     try:
-        # ネットワークI/Oをスレッドプールに任せる
-        url = await run_in_threadpool(get_360p_single_url, videoid)
-        return {"stream_url": url}
+        url = await get_360p_single_url(videoid)
+        return {"stream_url": proxiedMediaURL(url, proxy)}
     except Exception as e:
         return Response(content=f'{{"error": "Failed to get 360p URL: {e}"}}', media_type="application/json", status_code=503)
 
+@app.get("/api/stream_formats/{videoid}")
+async def stream_formats_route(videoid: str, itag: Union[int, None] = None, height: Union[int, None] = None, fps: Union[int, None] = None,
+                               vcodec: Union[str, None] = None, acodec: Union[str, None] = None, container: Union[str, None] = None,
+                               proxy: Union[str] = Cookie(None)):
+    """
+    動画のフォーマットをJSONで返す。itag・height などを指定すると条件に合うものだけを返す (画質の切り替え用)。
+    /api/stream_360p_url や /api/stream_high と同じインデックスから答えるので、切り替えのたびに上流へは問い合わせない。
+    """
+    try:
+        index = await getStreamIndex(videoid)
+    except (httpx.HTTPError, APITimeoutError, ValueError):
+        return Response(content='{"error": "Failed to load stream formats"}', media_type="application/json", status_code=503)
+    return {"title": index.title, "formats": [
+        {"itag": f.get("itag"), "quality": f.get("quality"), "ext": f.get("ext"), "height": index.height(f) or None,
+         "fps": index.fps(f) if f.get("vcodec") != "none" else None, "vcodec": f.get("vcodec"), "acodec": f.get("acodec"),
+         "url": proxiedMediaURL(f["url"], proxy)}
+        for f in index.find(itag=itag, height=height, fps=fps, vcodec=vcodec, acodec=acodec, container=container)
+    ]}
+
 # 新規追加: /api/edu/{videoid} ルート (全画面埋め込み)
 @app.get('/api/edu/{videoid}', response_class=HTMLResponse)
 async def embed_edu_video(request: Request, videoid: str, proxy: Union[str] = Cookie(None)):
@@ -473,14 +2717,14 @@ async def embed_edu_video(request: Request, videoid: str, proxy: Union[str] = Co
         # 外部APIから埋め込みURLを取得
         embed_url = await fetch_embed_url_from_external_api(videoid)
         
-    except requests.exceptions.HTTPError as e:
+    except httpx.HTTPStatusError as e:
         status_code = e.response.status_code
         if status_code == 404:
             return Response(f"Stream URL for videoid '{videoid}' not found.", status_code=404)
         print(f"Error calling external API (HTTP {status_code}): {e}")
         return Response("Failed to retrieve stream URL from external service (HTTP Error).", status_code=503)
         
-    except (requests.exceptions.RequestException, ValueError, json.JSONDecodeError) as e:
+    except (httpx.HTTPError, ValueError, json.JSONDecodeError) as e:
         print(f"Error calling external API: {e}")
         return Response("Failed to retrieve stream URL from external service (Connection/Format Error).", status_code=503)
 
@@ -496,25 +2740,119 @@ async def embed_edu_video(request: Request, videoid: str, proxy: Union[str] = Co
     )
 
 
+@app.get("/api/batch/videos")
+async def batch_videos_route(ids: str, format: str = "ndjson"):
+    """
+    カンマ区切りの動画IDの概要をまとめて返す。既定では取得できた順に1行ずつ NDJSON で送信する
+    ({"id": ..., "video": {...}} または {"id": ..., "error": ...})。
+    format=json の場合はすべて揃ってから {"videos": {...}, "errors": {...}} を返す。
+    """
+    videoids = list(dict.fromkeys(i.strip() for i in ids.split(",") if i.strip()))
+    if not videoids:
+        return Response(content='{"error": "No video IDs were given"}', media_type="application/json", status_code=400)
+    if len(videoids) > BATCH_MAX_VIDEOS:
+        return Response(content=json.dumps({"error": f"At most {BATCH_MAX_VIDEOS} video IDs can be requested at once"}), media_type="application/json", status_code=400)
+
+    if format == "json":
+        videos, errors = {}, {}
+        async for videoid, summary, error in getVideoSummaries(videoids):
+            if summary is not None:
+                videos[videoid] = summary
+            else:
+                errors[videoid] = error
+        return {"videos": videos, "errors": errors}
+
+    async def lines():
+        async for videoid, summary, error in getVideoSummaries(videoids):
+            item = {"id": videoid, "video": summary} if summary is not None else {"id": videoid, "error": error}
+            yield json.dumps(item, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+@app.get("/metrics")
+async def metrics_route():
+    """Prometheus のテキスト形式でメトリクスを返す"""
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/api/cache_stats")
+async def cache_stats_route():
+    """レスポンスキャッシュのヒット/ミス数などを返す"""
+    return response_cache.stats()
+
+
 # --- Frontend Routes ---
 
 @app.get('/', response_class=HTMLResponse)
 async def home(request: Request, proxy: Union[str] = Cookie(None)):
+    snapshot = trending_snapshots.get(TRENDING_REGIONS[0]) if TRENDING_REGIONS else None
     return templates.TemplateResponse("index.html", {
         "request": request, 
+        "trending": snapshot.videos[:TRENDING_HOME_COUNT] if snapshot else (),
         "proxy": proxy
-    })
+    }, headers=NO_STORE_HEADERS if snapshot is None and TRENDING_REGIONS else None)
+
+@app.get('/trending', response_class=HTMLResponse)
+async def trending(request: Request, region: Union[str, None] = None, proxy: Union[str] = Cookie(None)):
+    region = (region or (TRENDING_REGIONS[0] if TRENDING_REGIONS else "JP")).upper()
+    if not re.fullmatch(r"[A-Z]{2}", region):
+        return Response("Invalid region.", status_code=400)
+
+    snapshot = trending_snapshots.get(region)
+    if snapshot is not None:
+        videos = snapshot.videos
+    else:
+        # スナップショットを作っていないリージョン (または起動直後) はキャッシュ経由で取得する
+        try:
+            videos = await getTrendingData(region)
+        except (APITimeoutError, ValueError, KeyError):
+            videos = []
+    return templates.TemplateResponse("trending.html", {"request": request, "results": videos, "region": region, "proxy": proxy}, headers=None if videos else NO_STORE_HEADERS)
+
+def videoPageInfo(video_data):
+    """video.html で load_video_info() が返す動画情報"""
+    return {
+        "description": video_data[0]['description_html'], "video_title": video_data[0]['title'], "author_id": video_data[0]['author_id'], "author_icon": video_data[0]['author_thumbnails_url'], "author": video_data[0]['author'], "length_text": video_data[0]['length_text'], "view_count": video_data[0]['view_count'], "like_count": video_data[0]['like_count'], "subscribers_count": video_data[0]['subscribers_count'], "recommended_videos": video_data[1]
+    }
+
+def streamVideoPage(v, request, proxy):
+    """
+    video.html をストリーミングで返す。ヘッダーとプレーヤーの外枠を即座に送信し、
+    動画情報 (メタデータとおすすめ動画) は上流から届きしだい続けて送信する。
+    """
+    async def body():
+        video_task = asyncio.ensure_future(getVideoData(v))
+
+        async def load_video_info():
+            try:
+                return videoPageInfo(await video_task)
+            except Exception as e:
+                print(f"Failed to load video data for {v}: {e}")
+                return None
+
+        try:
+            async for chunk in streamTemplate('video.html', {
+                "request": request, "videoid": v, "high_quality_url": "",
+                "load_video_info": load_video_info, "stream_flush": STREAM_FLUSH, "proxy": proxy
+            }):
+                yield chunk
+        finally:
+            video_task.cancel()
+
+    return StreamingResponse(body(), media_type="text/html; charset=utf-8")
 
 @app.get('/watch', response_class=HTMLResponse)
 async def video(v:str, request: Request, proxy: Union[str] = Cookie(None)):
+    if STREAM_WATCH_PAGE:
+        return streamVideoPage(v, request, proxy)
+
     video_data = await getVideoData(v)
+    info = videoPageInfo(video_data)
     
     high_quality_url = ""
     
     return templates.TemplateResponse('video.html', {
-        "request": request, "videoid": v, "videourls": video_data[0]['video_urls'], 
-        "high_quality_url": high_quality_url,
-        "description": video_data[0]['description_html'], "video_title": video_data[0]['title'], "author_id": video_data[0]['author_id'], "author_icon": video_data[0]['author_thumbnails_url'], "author": video_data[0]['author'], "length_text": video_data[0]['length_text'], "view_count": video_data[0]['view_count'], "like_count": video_data[0]['like_count'], "subscribers_count": video_data[0]['subscribers_count'], "recommended_videos": video_data[1], "proxy":proxy
+        "request": request, "videoid": v, "high_quality_url": high_quality_url,
+        "video_title": info["video_title"], "load_video_info": lambda: info, "proxy":proxy
     })
 
 @app.get("/search", response_class=HTMLResponse)
@@ -529,23 +2867,135 @@ async def hashtag_search(tag:str):
 @app.get("/channel/{channelid}", response_class=HTMLResponse)
 async def channel(channelid:str, request: Request, proxy: Union[str] = Cookie(None)):
     t = await getChannelData(channelid)
-    return templates.TemplateResponse("channel.html", {"request": request, "results": t[0], "channel_name": t[1]["channel_name"], "channel_icon": t[1]["channel_icon"], "channel_profile": t[1]["channel_profile"], "cover_img_url": t[1]["author_banner"], "subscribers_count": t[1]["subscribers_count"], "tags": t[1]["tags"], "proxy": proxy})
+    return templates.TemplateResponse("channel.html", {"request": request, "results": t[0], "channel_name": t[1]["channel_name"], "channel_icon": t[1]["channel_icon"], "channel_profile": t[1]["channel_profile"], "cover_img_url": t[1]["author_banner"], "subscribers_count": t[1]["subscribers_count"], "tags": t[1]["tags"], "proxy": proxy}, headers=None if t[0] else NO_STORE_HEADERS)
 
 @app.get("/playlist", response_class=HTMLResponse)
-async def playlist(list:str, request: Request, page:Union[int, None]=1, proxy: Union[str] = Cookie(None)):
+async def playlist(list:str, request: Request, page:Union[int, None]=1, all: bool = False, proxy: Union[str] = Cookie(None)):
+    if all:
+        index = await getFullPlaylist(list)
+        return templates.TemplateResponse("search.html", {"request": request, "results": index.videos(), "word": "", "next": None, "proxy": proxy}, headers=None if index.complete else NO_STORE_HEADERS)
     playlist_data = await getPlaylistData(list, str(page))
-    return templates.TemplateResponse("search.html", {"request": request, "results": playlist_data, "word": "", "next": f"/playlist?list={list}&page={page + 1}", "proxy": proxy})
+    return templates.TemplateResponse("search.html", {"request": request, "results": playlist_data, "word": "", "next": f"/playlist?list={list}&page={page + 1}", "all_url": f"/playlist?list={list}&all=1", "proxy": proxy})
+
+@app.get("/api/playlist/{listid}")
+async def playlist_videos_route(listid: str):
+    """プレイリスト全体の動画一覧をJSONで返す (連続再生用)"""
+    try:
+        index = await getFullPlaylist(listid)
+    except (APITimeoutError, ValueError, KeyError):
+        return Response(content='{"error": "Failed to load the playlist"}', media_type="application/json", status_code=502)
+    body = {"title": index.title, "complete": index.complete, "video_ids": index.video_ids, "videos": index.videos()}
+    if not index.complete:
+        return Response(content=json.dumps(body), media_type="application/json", headers=NO_STORE_HEADERS)  # 途中までの一覧はキャッシュさせない
+    return body
 
 @app.get("/comments", response_class=HTMLResponse)
-async def comments(request: Request, v:str):
-    comments_data = await getCommentsData(v)
-    return templates.TemplateResponse("comments.html", {"request": request, "comments": comments_data})
+async def comments(request: Request, v:str, continuation: Union[str, None] = None):
+    page = await getCommentsData(v, continuation)
+    return templates.TemplateResponse("comments.html", {"request": request, "videoid": v, "comments": page.comments, "continuation": page.continuation})
+
+@app.get("/comments/fragment", response_class=HTMLResponse)
+async def comments_fragment(request: Request, v:str, continuation: Union[str, None] = None):
+    """コメント1ページ分のHTML断片を返す (動画ページで続きを読み込むとき用)"""
+    try:
+        page = await getCommentsData(v, continuation)
+    except (APITimeoutError, ValueError, KeyError):
+        return Response("Failed to load comments.", status_code=502)
+    return templates.TemplateResponse("comments_fragment.html", {"request": request, "videoid": v, "comments": page.comments, "continuation": page.continuation})
+
+@app.get("/proxy/media")
+async def media_proxy(url: str, request: Request):
+    """
+    googlevideo のメディアを中継する。Range などの条件付きヘッダーはそのまま上流へ転送する。
+    """
+    if not isProxyableMediaURL(url):
+        return Response("This URL cannot be proxied.", status_code=400)
+
+    slots = getMediaProxySlots()
+    if slots.locked():
+        return Response("Too many proxied streams.", status_code=503, headers={"Retry-After": "5"})
+    await slots.acquire()
+    metrics.media_streams += 1
+
+    headers = {k: v for k, v in request.headers.items() if k.lower() in MEDIA_PROXY_REQUEST_HEADERS}
+    try:
+        upstream = await http_stream(url, timeout=MEDIA_PROXY_TIMEOUT, headers=headers)
+    except httpx.HTTPError:
+        slots.release()
+        metrics.media_streams -= 1
+        return Response("Failed to connect to the media server.", status_code=502)
+    except BaseException:
+        slots.release()
+        metrics.media_streams -= 1
+        raise
+
+    return MediaProxyResponse(upstream, slots)
 
 @app.get("/thumbnail")
-def thumbnail(v:str):
-    return Response(content = requests.get(f"https://img.youtube.com/vi/{v}/0.jpg").content, media_type="image/jpeg")
+async def thumbnail(v:str, request: Request):
+    cache_headers = {"Cache-Control": f"public, max-age={THUMBNAIL_MAX_AGE}"}
+    cacheable = thumbnail_cache.cacheable(v)
+
+    cached = await thumbnail_cache.get(v) if cacheable else None
+    if cached is not None:
+        content, etag = cached
+        headers = dict(cache_headers, ETag=etag)
+        if etagMatches(etag, request.headers.get("if-none-match")):
+            return Response(status_code=304, headers=headers)
+        return Response(content=content, media_type="image/jpeg", headers=headers)
+
+    try:
+        res = await http_stream(THUMBNAIL_URL.format(urllib.parse.quote(v)))
+    except httpx.HTTPError:
+        return Response(status_code=502)
+
+    async def body():
+        chunks = []
+        try:
+            async for chunk in res.aiter_bytes():
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            await res.aclose()
+        # 最後まで転送できた正常な画像だけをキャッシュする
+        if cacheable and res.status_code == httpx.codes.OK:
+            spawn_background(thumbnail_cache.put(v, b"".join(chunks)))
+
+    return StreamingResponse(body(), status_code=res.status_code, media_type="image/jpeg", headers=cache_headers if res.status_code == httpx.codes.OK else None)
 
 @app.get("/suggest")
-def suggest(keyword:str):
-    res_text = requests.get("http://www.google.com/complete/search?client=youtube&hl=ja&ds=yt&q=" + urllib.parse.quote(keyword), headers=getRandomUserAgent()).text
-    return [i[0] for i in json.loads(res_text[19:-1])[1]]
+async def suggest(keyword:str, request: Request, sid: Union[str, None] = None):
+    """
+    検索候補を返す。sid は外部のクライアント向けの省略可能なパラメーター (このアプリのテンプレートは送らない)。
+    指定されていれば、同じ sid のより短いキーワードの取得を打ち切る。sid の無い要求は打ち切らないので、
+    その場合は古いキーワードの取得もそのまま最後まで実行される (プロキシの背後では接続元のアドレスで利用者を区別できないため)。
+    """
+    cached = suggest_index.lookup(keyword)
+    if cached is not None:
+        return cached
+
+    if not sid:
+        try:
+            return await fetchSuggestions(keyword)
+        except (httpx.HTTPError, ValueError, IndexError):
+            return []
+
+    # 同じ検索ボックスのより短いキーワードの要求が実行中なら、もう不要なので打ち切る
+    previous = _suggest_inflight.get(sid)
+    normalized = SuggestIndex.normalize(keyword)
+    if previous is not None and normalized.startswith(previous[0]) and normalized != previous[0]:
+        previous[1].cancel()
+
+    task = asyncio.ensure_future(fetchSuggestions(keyword))
+    _suggest_inflight[sid] = (normalized, task)
+    try:
+        return await task
+    except asyncio.CancelledError:
+        if task.cancelled() and _suggest_inflight.get(sid, (None, None))[1] is not task:
+            return Response(status_code=204)  # 後続のキーワードに置き換えられた
+        raise
+    except (httpx.HTTPError, ValueError, IndexError):
+        return []
+    finally:
+        if _suggest_inflight.get(sid, (None, None))[1] is task:
+            del _suggest_inflight[sid]
@@ -0,0 +1,71 @@
+"""
+デプロイ前 (ビルド時) に実行して、起動後の最初の処理でコンパイルが走らないようにする。
+
+- テンプレートを Jinja のバイトコードキャッシュ (TEMPLATE_CACHE_DIR) に書き出す
+- static/ のファイルを gzip と brotli (インストールされていれば) で圧縮しておく (style.css.gz など)
+- app パッケージの .pyc を作成する (読み取り専用の環境では実行時に書き込めないため)
+
+    python -m app.precompile
+
+Vercel (@vercel/python) にはビルド手順が無いため、テンプレートのキャッシュだけを vercel_template_cache/ に
+作成してコミットする。vercel.json の runtime と同じバージョンの Python で実行すること。テンプレートを変更したら作り直す。
+
+    python3.9 -m app.precompile --vercel
+
+--check を付けると書き出さずに検査だけを行い、作り直していないテンプレートがあれば失敗する (コミット前やCIで実行する)。
+Jinja はチェックサムの合わないキャッシュを何も言わずに無視して実行時にコンパイルするため、古いままでも気づけない。
+
+    python3.9 -m app.precompile --vercel --check
+"""
+import argparse
+import compileall
+import json
+import os
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def vercelRuntime():
+    """vercel.json の runtime (例: "python3.9") を (3, 9) の形で返す"""
+    config = json.loads((ROOT / "vercel.json").read_text())
+    runtime = next(b["config"]["runtime"] for b in config["builds"] if b["use"] == "@vercel/python")
+    return tuple(int(n) for n in runtime.removeprefix("python").split("."))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vercel", action="store_true", help="Vercel 用のテンプレートキャッシュ (vercel_template_cache/) を作成する")
+    parser.add_argument("--check", action="store_true", help="キャッシュがテンプレートと一致するかだけを検査する")
+    args = parser.parse_args()
+
+    if args.vercel:
+        runtime = vercelRuntime()
+        if sys.version_info[:2] != runtime:
+            raise SystemExit(f"Run this with Python {'.'.join(map(str, runtime))} (the Vercel runtime); this is {sys.version.split()[0]}.")
+        os.environ["VERCEL"] = "1"
+        os.environ.pop("TEMPLATE_CACHE_DIR", None)
+
+    from app.main import TEMPLATE_CACHE_DIR, precompileTemplates, staleTemplateCaches, static_assets
+
+    if args.check:
+        stale = staleTemplateCaches()
+        for kind, name in stale:
+            print(f"stale {kind} cache: {name}")
+        if stale:
+            raise SystemExit(f"{len(stale)} template caches in {TEMPLATE_CACHE_DIR} are out of date; rerun without --check.")
+        print(f"template caches in {TEMPLATE_CACHE_DIR} are up to date")
+        return
+
+    names = precompileTemplates()
+    print(f"compiled {len(names)} templates into {TEMPLATE_CACHE_DIR}")
+    if args.vercel:
+        return
+    files = static_assets.precompress()
+    print(f"precompressed {len(files)} static files")
+    compileall.compile_dir(str(Path(__file__).resolve().parent), quiet=1)
+
+
+if __name__ == "__main__":
+    main()
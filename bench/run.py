@@ -0,0 +1,272 @@
+"""
+オフラインのベンチマーク。
+
+上流 (Invidious / pmpmpm / img.youtube.com など) をローカルのスタブに置き換えてアプリを起動し、
+負荷をかけてルートごとのスループットと p50/p95/p99 レイテンシを計測する。
+結果はJSONで保存するので、バージョン間で比較できる。
+
+    python -m bench.run --duration 30 --concurrency 50 --output bench/results/current.json
+    python -m bench.run --dead 2 --dead-mode hang --error-rate 0.05 --compare bench/results/current.json
+
+主なオプション:
+    --instances / --dead / --dead-mode   Invidiousスタブの数と、そのうち停止させる数・停止のしかた
+    --latency / --jitter / --error-rate   スタブの応答時間 (秒) とエラー率
+    --routes                              計測するルートと重み (例: watch=3,search=2,thumbnail=5)
+    --keys                                動画IDなどの種類数。少ないほどキャッシュが効く
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+ROOT = Path(__file__).resolve().parent.parent
+
+ROUTES = {
+    "watch": lambda key: f"/watch?v={key}",
+    "search": lambda key: f"/search?q=query{key}",
+    "channel": lambda key: f"/channel/UC{key}",
+    "playlist": lambda key: f"/playlist?list=PL{key}",
+    "comments": lambda key: f"/comments?v={key}",
+    "thumbnail": lambda key: f"/thumbnail?v={key}",
+    "suggest": lambda key: f"/suggest?keyword=word{key}",
+    "stream_360p": lambda key: f"/api/stream_360p_url/{key}",
+    "stream_high": lambda key: f"/api/stream_high/{key}",
+    "stream_formats": lambda key: f"/api/stream_formats/{key}?height=1080",
+    "home": lambda key: "/",
+    "trending": lambda key: "/trending",
+}
+DEFAULT_ROUTES = "watch=3,search=2,channel=1,playlist=1,comments=2,thumbnail=6,suggest=3,stream_360p=1,stream_high=1"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(q / 100 * len(values)) - 1))]
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def stub_config(args):
+    spec = {"latency": args.latency, "jitter": args.jitter, "error_rate": args.error_rate}
+    invidious = []
+    for n in range(args.instances):
+        invidious.append(dict(spec, port=free_port(), dead=args.dead_mode if n < args.dead else None))
+    return {"host": "127.0.0.1", "invidious": invidious, "media": dict(spec, port=free_port())}
+
+
+def start_process(module, *argv, env=None, stdout=None):
+    return subprocess.Popen([sys.executable, "-m", module, *argv], cwd=ROOT, env=env, stdout=stdout, text=True)
+
+
+async def wait_until_ready(url, timeout=30.0):
+    deadline = time.time() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.time() < deadline:
+            try:
+                await client.get(url)
+                return
+            except httpx.HTTPError:
+                await asyncio.sleep(0.1)
+    raise RuntimeError(f"{url} did not become ready in {timeout} seconds.")
+
+
+class Recorder:
+    def __init__(self):
+        self.latency = {}
+        self.ttfb = {}
+        self.errors = {}
+
+    def add(self, route, latency, ttfb, ok):
+        self.latency.setdefault(route, []).append(latency)
+        self.ttfb.setdefault(route, []).append(ttfb)
+        if not ok:
+            self.errors[route] = self.errors.get(route, 0) + 1
+
+    def summary(self, elapsed):
+        routes = {}
+        for route, values in sorted(self.latency.items()):
+            routes[route] = {
+                "requests": len(values),
+                "errors": self.errors.get(route, 0),
+                "rps": len(values) / elapsed,
+                "p50_ms": percentile(values, 50) * 1000,
+                "p95_ms": percentile(values, 95) * 1000,
+                "p99_ms": percentile(values, 99) * 1000,
+                "ttfb_p50_ms": percentile(self.ttfb[route], 50) * 1000,
+                "ttfb_p99_ms": percentile(self.ttfb[route], 99) * 1000,
+            }
+        every = [v for values in self.latency.values() for v in values]
+        total = {
+            "requests": len(every),
+            "errors": sum(self.errors.values()),
+            "rps": len(every) / elapsed,
+            "p50_ms": (percentile(every, 50) or 0) * 1000,
+            "p95_ms": (percentile(every, 95) or 0) * 1000,
+            "p99_ms": (percentile(every, 99) or 0) * 1000,
+        }
+        return routes, total
+
+
+def parse_routes(spec):
+    routes = []
+    for item in spec.split(","):
+        name, _, weight = item.partition("=")
+        if name not in ROUTES:
+            raise SystemExit(f"Unknown route: {name} (choose from {', '.join(ROUTES)})")
+        routes.append((name, float(weight or 1)))
+    return routes
+
+
+def pick_key(rng, keys):
+    # 人気の偏り (少数の動画にアクセスが集中する) を近似する
+    return f"k{int(rng.paretovariate(1.2) * 7) % keys:06d}"
+
+
+async def load(base_url, args, recorder, warmup_until, deadline):
+    routes = parse_routes(args.routes)
+    names = [name for name, _ in routes]
+    weights = [weight for _, weight in routes]
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=args.timeout) as client:
+        async def worker(seed):
+            rng = random.Random(seed)
+            while time.time() < deadline:
+                route = rng.choices(names, weights)[0]
+                path = ROUTES[route](pick_key(rng, args.keys))
+                start = time.perf_counter()
+                ttfb = None
+                try:
+                    async with client.stream("GET", path) as res:
+                        ttfb = time.perf_counter() - start
+                        await res.aread()
+                    ok = res.status_code < 400
+                except httpx.HTTPError:
+                    ok = False
+                latency = time.perf_counter() - start
+                if time.time() >= warmup_until:
+                    recorder.add(route, latency, ttfb if ttfb is not None else latency, ok)
+
+        await asyncio.gather(*(worker(n) for n in range(args.concurrency)))
+
+
+def print_report(result, baseline=None):
+    header = f"{'route':<12} {'reqs':>7} {'err':>5} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'ttfb50':>8}"
+    print(header)
+    print("-" * len(header))
+    for route, r in result["routes"].items():
+        print(f"{route:<12} {r['requests']:>7} {r['errors']:>5} {r['rps']:>8.1f} {r['p50_ms']:>8.1f} {r['p95_ms']:>8.1f} {r['p99_ms']:>8.1f} {r['ttfb_p50_ms']:>8.1f}")
+    t = result["total"]
+    print(f"{'TOTAL':<12} {t['requests']:>7} {t['errors']:>5} {t['rps']:>8.1f} {t['p50_ms']:>8.1f} {t['p95_ms']:>8.1f} {t['p99_ms']:>8.1f}")
+
+    if baseline is None:
+        return
+    print(f"\ncompared with {baseline.get('label') or baseline.get('revision')} (negative latency / positive rps is better)")
+    for route, r in result["routes"].items():
+        old = baseline["routes"].get(route)
+        if not old:
+            continue
+        def delta(key):
+            return (r[key] - old[key]) / old[key] * 100 if old[key] else 0.0
+        print(f"{route:<12} rps {delta('rps'):>+7.1f}%  p50 {delta('p50_ms'):>+7.1f}%  p99 {delta('p99_ms'):>+7.1f}%")
+
+
+async def run(args):
+    workdir = Path(tempfile.mkdtemp(prefix="yuzutube-bench-"))
+    config = stub_config(args)
+    config_path = workdir / "stubs.json"
+    config_path.write_text(json.dumps(config))
+    port = free_port()
+
+    stubs = start_process("bench.stubs", "--config", str(config_path), stdout=subprocess.PIPE)
+    target = None
+    try:
+        if stubs.stdout.readline().strip() != "ready":
+            raise RuntimeError("Stub servers failed to start.")
+        env = dict(os.environ, THUMBNAIL_CACHE_DIR=str(workdir / "thumbnails"))
+        target = start_process("bench.target", "--config", str(config_path), "--port", str(port), env=env)
+        base_url = f"http://127.0.0.1:{port}"
+        await wait_until_ready(base_url + "/")
+
+        recorder = Recorder()
+        started = time.time()
+        warmup_until = started + args.warmup
+        deadline = warmup_until + args.duration
+        await load(base_url, args, recorder, warmup_until, deadline)
+        routes, total = recorder.summary(args.duration)
+    finally:
+        for process in (target, stubs):
+            if process is not None:
+                process.terminate()
+                try:
+                    process.wait(timeout=5)
+                except subprocess.TimeoutExpired:
+                    # 応答しないスタブへの接続が残っていると正常終了を待ち続けるため
+                    process.kill()
+                    process.wait()
+
+    return {
+        "label": args.label,
+        "revision": git_revision(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": sys.version.split()[0],
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        "routes": routes,
+        "total": total,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=20.0, help="計測時間 (秒)")
+    parser.add_argument("--warmup", type=float, default=3.0, help="計測前のウォームアップ時間 (秒)")
+    parser.add_argument("--concurrency", type=int, default=32, help="同時接続数 (クローズドループのワーカー数)")
+    parser.add_argument("--timeout", type=float, default=15.0, help="1リクエストのタイムアウト (秒)")
+    parser.add_argument("--routes", default=DEFAULT_ROUTES)
+    parser.add_argument("--keys", type=int, default=500)
+    parser.add_argument("--instances", type=int, default=5)
+    parser.add_argument("--dead", type=int, default=0)
+    parser.add_argument("--dead-mode", choices=("hang", "refuse", "error"), default="hang")
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--label", default=None, help="結果に付ける名前 (省略時は git のリビジョン)")
+    parser.add_argument("--output", default=None, help="結果を書き出すJSONファイル (省略時は bench/results/<日時>.json)")
+    parser.add_argument("--compare", default=None, help="比較対象の結果JSON")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+
+    output = Path(args.output) if args.output else ROOT / "bench" / "results" / f"{time.strftime('%Y%m%d-%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(result, indent=2, ensure_ascii=False))
+
+    baseline = json.loads(Path(args.compare).read_text()) if args.compare else None
+    print_report(result, baseline)
+    print(f"\nresults written to {output}")
+
+
+if __name__ == "__main__":
+    main()
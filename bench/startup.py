@@ -0,0 +1,142 @@
+"""
+起動時間の計測。
+
+新しいプロセスで app.main を読み込み、サーバーレス環境と同じように lifespan を経由せずに
+最初のリクエストを処理するまでの時間を測る。通常の起動と高速起動モード (FAST_START=1 と
+ビルド時にコンパイルしたテンプレート) を比べる。上流への通信が必要ないページを対象にする。
+
+    python -m bench.startup --runs 10
+    python -m bench.startup --paths /,/trending?region=ZZ --output bench/results/startup.json
+
+表示する値 (いずれも中央値, ミリ秒):
+    process   プロセスの起動から終了まで (インタープリタの起動を含む)
+    import    app.main の読み込み
+    first     最初のリクエストの処理 (パスごと)
+    second    2回目のリクエストの処理 (比較用)
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+DEFAULT_PATHS = "/,/static/style.css"
+
+
+async def call(app, path):
+    """ASGIアプリを直接呼び出してレスポンスの完了までの時間を返す"""
+    path, _, query = path.partition("?")
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+        "path": path, "raw_path": path.encode(), "query_string": query.encode(), "root_path": "",
+        "headers": [(b"host", b"localhost")], "client": ("127.0.0.1", 0), "server": ("localhost", 80),
+    }
+    received = False
+    done = asyncio.Event()
+    status = []
+
+    async def receive():
+        nonlocal received
+        if not received:
+            received = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await done.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            status.append(message["status"])
+        elif message["type"] == "http.response.body" and not message.get("more_body"):
+            done.set()
+
+    start = time.perf_counter()
+    await app(scope, receive, send)
+    return time.perf_counter() - start, status[0] if status else None
+
+
+def child(paths):
+    start = time.perf_counter()
+    import app.main
+    imported = time.perf_counter() - start
+
+    async def requests():
+        first, second = {}, {}
+        for path in paths:
+            first[path], status = await call(app.main.app, path)
+            if status != 200:
+                raise SystemExit(f"{path} returned {status}")
+            second[path], _ = await call(app.main.app, path)
+        return first, second
+
+    first, second = asyncio.run(requests())
+    print(json.dumps({"import": imported, "first": first, "second": second}))
+
+
+def measure(env, paths, runs):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        out = subprocess.run([sys.executable, "-m", "bench.startup", "--child", "--paths", ",".join(paths)],
+                             cwd=ROOT, env=env, capture_output=True, text=True, check=True).stdout
+        sample = json.loads(out.strip().splitlines()[-1])
+        sample["process"] = time.perf_counter() - start
+        samples.append(sample)
+
+    def median(values):
+        return statistics.median(values) * 1000
+
+    return {
+        "process_ms": median([s["process"] for s in samples]),
+        "import_ms": median([s["import"] for s in samples]),
+        "first_ms": {path: median([s["first"][path] for s in samples]) for path in paths},
+        "second_ms": {path: median([s["second"][path] for s in samples]) for path in paths},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="モードごとのプロセス起動回数")
+    parser.add_argument("--paths", default=DEFAULT_PATHS, help="最初に処理させるパス (カンマ区切り)")
+    parser.add_argument("--output", default=None, help="結果を書き出すJSONファイル")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    paths = [p for p in args.paths.split(",") if p]
+
+    if args.child:
+        child(paths)
+        return
+
+    workdir = Path(tempfile.mkdtemp(prefix="yuzutube-startup-"))
+    base = dict(os.environ, THUMBNAIL_CACHE_DIR=str(workdir / "thumbnails"), TRENDING_REGIONS="")
+    base.pop("SHARED_STORE_URL", None)
+    template_cache = workdir / "templates"
+    subprocess.run([sys.executable, "-m", "app.precompile"], cwd=ROOT, env=dict(base, TEMPLATE_CACHE_DIR=str(template_cache)), check=True, capture_output=True)
+
+    modes = {
+        "default": dict(base, FAST_START="0", TEMPLATE_CACHE_DIR=str(workdir / "missing")),
+        "fast": dict(base, FAST_START="1", TEMPLATE_CACHE_DIR=str(template_cache)),
+    }
+    results = {name: measure(env, paths, args.runs) for name, env in modes.items()}
+
+    header = f"{'mode':<10} {'process':>9} {'import':>9}" + "".join(f" {'first ' + p:>20}" for p in paths)
+    print(header)
+    print("-" * len(header))
+    for name, r in results.items():
+        print(f"{name:<10} {r['process_ms']:>9.1f} {r['import_ms']:>9.1f}" + "".join(f" {r['first_ms'][p]:>20.1f}" for p in paths))
+    print("\nsecond request (ms): " + ", ".join(f"{p} {results['fast']['second_ms'][p]:.1f}" for p in paths))
+
+    if args.output:
+        output = Path(args.output)
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_text(json.dumps({"python": sys.version.split()[0], "runs": args.runs, "modes": results}, indent=2))
+        print(f"results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+"""
+ベンチマーク用の上流スタブサーバー。
+
+Invidious (/api/v1/videos|search|channels|playlists|comments|trending|stats)、
+pmpmpm (/dl/{videoid})、img.youtube.com (/vi/{videoid}/0.jpg)、Googleの検索候補、
+siawaseok と kahoot の代わりになる応答を、ローカルのポートで返す。
+
+Invidiousインスタンスはポートごとに1つずつ立ち上げ、それぞれにレイテンシ・エラー率・
+停止 (dead) 状態を設定できる。単体で起動する場合:
+
+    python -m bench.stubs --config stubs.json
+
+設定の形式は StubConfig を参照。起動が完了すると標準出力に "ready" を1行書く。
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+THUMBNAIL_BYTES = b"\xff\xd8\xff\xe0" + bytes(range(256)) * 60  # 約15KBのダミーJPEG
+
+
+class StubConfig:
+    """
+    {
+      "host": "127.0.0.1",
+      "invidious": [{"port": 9001, "latency": 0.05, "jitter": 0.02, "error_rate": 0.0, "dead": null}, ...],
+      "media": {"port": 9100, "latency": 0.1, "jitter": 0.05, "error_rate": 0.0}
+    }
+    dead は null / "hang" (応答しない) / "refuse" (待ち受けない) / "error" (常に500)。
+    media は pmpmpm・サムネイル・検索候補・siawaseok・kahoot をまとめて受け持つ。
+    """
+    def __init__(self, data):
+        self.host = data.get("host", "127.0.0.1")
+        self.invidious = data["invidious"]
+        self.media = data["media"]
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+
+def _video_id(n):
+    return f"vid{n:08d}"
+
+
+def video_payload(videoid):
+    rng = random.Random(videoid)
+    expire = int(time.time()) + 6 * 3600
+    return {
+        "type": "video",
+        "title": f"Video {videoid}",
+        "videoId": videoid,
+        "descriptionHtml": "説明文\n" * 40,
+        "lengthSeconds": rng.randint(30, 3600),
+        "authorId": f"UC{videoid}",
+        "author": f"Author {videoid}",
+        "authorThumbnails": [{"url": f"https://yt3.ggpht.com/{videoid}/{size}", "width": size} for size in (32, 48, 76, 100, 176, 512)],
+        "viewCount": rng.randint(0, 10 ** 8),
+        "likeCount": rng.randint(0, 10 ** 6),
+        "subCountText": "12.3万",
+        "formatStreams": [
+            {"url": f"https://rr1---sn-stub.googlevideo.com/videoplayback?itag={itag}&id={videoid}&expire={expire}", "itag": str(itag)}
+            for itag in (18, 22)
+        ],
+        "adaptiveFormats": [
+            {"url": f"https://rr1---sn-stub.googlevideo.com/videoplayback?itag={itag}&id={videoid}&expire={expire}", "itag": str(itag), "bitrate": str(rng.randint(10 ** 5, 10 ** 7))}
+            for itag in (137, 248, 136, 247, 135, 134, 133, 140, 251, 250, 249)
+        ],
+        "recommendedVideos": [
+            {"videoId": _video_id(rng.randint(0, 10 ** 6)), "title": f"Recommended {i}", "authorId": f"UCrec{i}", "author": f"Rec author {i}",
+             "lengthSeconds": rng.randint(30, 3600), "viewCountText": f"{rng.randint(1, 999)}万 回視聴"}
+            for i in range(20)
+        ],
+    }
+
+
+def search_payload(query, count=20):
+    rng = random.Random(query)
+    items = []
+    for i in range(count):
+        kind = rng.choice(("video",) * 8 + ("channel", "playlist"))
+        if kind == "video":
+            videoid = _video_id(rng.randint(0, 10 ** 6))
+            items.append({"type": "video", "title": f"{query} {i}", "videoId": videoid, "author": f"Author {i}", "publishedText": "1 日前",
+                          "lengthSeconds": rng.randint(30, 3600), "viewCountText": f"{rng.randint(1, 999)} 回視聴"})
+        elif kind == "channel":
+            items.append({"type": "channel", "author": f"Channel {i}", "authorId": f"UCch{i}",
+                          "authorThumbnails": [{"url": f"//yt3.ggpht.com/ch{i}/{size}"} for size in (32, 176)]})
+        else:
+            items.append({"type": "playlist", "title": f"Playlist {i}", "playlistId": f"PL{i:032d}",
+                          "playlistThumbnail": "https://i.ytimg.com/vi/x/hqdefault.jpg", "videoCount": rng.randint(1, 500)})
+    return items
+
+
+def channel_payload(channelid):
+    return {
+        "author": f"Channel {channelid}",
+        "authorId": channelid,
+        "authorThumbnails": [{"url": f"https://yt3.ggpht.com/{channelid}/{size}"} for size in (32, 100, 176)],
+        "authorBanners": [{"url": f"https://yt3.ggpht.com/{channelid}/banner"}],
+        "descriptionHtml": "チャンネルの説明",
+        "subCount": 123456,
+        "tags": ["tag1", "tag2"],
+        "latestVideos": [
+            {"title": f"Latest {i}", "videoId": _video_id(i), "publishedText": f"{i} 日前", "viewCountText": f"{i} 回視聴", "lengthSeconds": 60 + i}
+            for i in range(30)
+        ],
+    }
+
+
+def playlist_payload(listid, page, video_count=250, page_size=100):
+    start = (page - 1) * page_size
+    return {
+        "title": f"Playlist {listid}",
+        "playlistId": listid,
+        "videoCount": video_count,
+        "videos": [
+            {"title": f"Item {n}", "videoId": _video_id(n), "authorId": f"UCa{n}", "author": f"Author {n}", "index": n}
+            for n in range(start, min(start + page_size, video_count))
+        ],
+    }
+
+
+def comments_payload(videoid, continuation=None, pages=5):
+    page = int(continuation[1:]) if continuation else 0
+    return {
+        "videoId": videoid,
+        "comments": [
+            {"author": f"User {page}-{i}", "authorThumbnails": [{"url": f"https://yt3.ggpht.com/u{i}/48"}], "authorId": f"UCu{i}",
+             "contentHtml": f"コメント {page}-{i}\n2行目"}
+            for i in range(20)
+        ],
+        "continuation": f"p{page + 1}" if page + 1 < pages else None,
+    }
+
+
+def dl_payload(videoid):
+    expire = int(time.time()) + 6 * 3600
+    url = f"https://rr1---sn-stub.googlevideo.com/videoplayback?id={videoid}&expire={expire}&itag="
+    formats = [
+        {"itag": 18, "ext": "mp4", "quality": "360p", "vcodec": "avc1.42001E", "acodec": "mp4a.40.2", "url": url + "18"},
+        {"itag": 137, "ext": "mp4", "quality": "1080p", "vcodec": "avc1.640028", "acodec": "none", "fps": 30, "url": url + "137"},
+        {"itag": 299, "ext": "mp4", "quality": "1080p60", "vcodec": "avc1.64002a", "acodec": "none", "fps": 60, "url": url + "299"},
+        {"itag": 136, "ext": "mp4", "quality": "720p", "vcodec": "avc1.4d401f", "acodec": "none", "fps": 30, "url": url + "136"},
+        {"itag": 248, "ext": "webm", "quality": "1080p", "vcodec": "vp9", "acodec": "none", "fps": 30, "url": url + "248"},
+        {"itag": 140, "ext": "m4a", "quality": "tiny", "vcodec": "none", "acodec": "mp4a.40.2", "abr": 129.5, "filesize": 3400000, "url": url + "140"},
+        {"itag": 251, "ext": "webm", "quality": "tiny", "vcodec": "none", "acodec": "opus", "abr": 135.1, "filesize": 3300000, "url": url + "251"},
+    ]
+    return {"res_data": {"title": f"Video {videoid}", "formats": formats}}
+
+
+class Behaviour:
+    """レイテンシ・エラー・停止状態をまとめて適用する"""
+    def __init__(self, spec):
+        self.latency = spec.get("latency", 0.0)
+        self.jitter = spec.get("jitter", 0.0)
+        self.error_rate = spec.get("error_rate", 0.0)
+        self.dead = spec.get("dead")
+
+    async def apply(self):
+        """エラー応答を返すべきならそのレスポンスを返す。正常なら None。"""
+        if self.dead == "hang":
+            await asyncio.sleep(3600)
+        if self.dead == "error":
+            return Response("Internal Server Error", status_code=500)
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.error_rate and random.random() < self.error_rate:
+            # 半分は500、半分はJSONでないHTML (Invidiousがよく返すエラーページ)
+            if random.random() < 0.5:
+                return Response("Internal Server Error", status_code=500)
+            return Response("<html><body>Error</body></html>", media_type="text/html")
+        return None
+
+
+def invidious_app(behaviour):
+    async def guarded(request, build):
+        error = await behaviour.apply()
+        if error is not None:
+            return error
+        return JSONResponse(build(request))
+
+    def route(path, build):
+        async def endpoint(request):
+            return await guarded(request, build)
+        return Route(path, endpoint)
+
+    return Starlette(routes=[
+        route("/api/v1/videos/{videoid}", lambda r: video_payload(r.path_params["videoid"])),
+        route("/api/v1/search", lambda r: search_payload(r.query_params.get("q", ""))),
+        route("/api/v1/trending", lambda r: [i for i in search_payload("trending-" + r.query_params.get("region", "JP"), 50) if i["type"] == "video"]),
+        route("/api/v1/channels/{channelid}", lambda r: channel_payload(r.path_params["channelid"])),
+        route("/api/v1/playlists/{listid}", lambda r: playlist_payload(r.path_params["listid"], int(r.query_params.get("page", 1)))),
+        route("/api/v1/comments/{videoid}", lambda r: comments_payload(r.path_params["videoid"], r.query_params.get("continuation"))),
+        route("/api/v1/stats", lambda r: {"version": "stub"}),
+    ])
+
+
+def media_app(behaviour):
+    async def dl(request):
+        error = await behaviour.apply()
+        return error or JSONResponse(dl_payload(request.path_params["videoid"]))
+
+    async def thumbnail(request):
+        error = await behaviour.apply()
+        return error or Response(THUMBNAIL_BYTES, media_type="image/jpeg")
+
+    async def suggest(request):
+        error = await behaviour.apply()
+        if error is not None:
+            return error
+        q = request.query_params.get("q", "")
+        body = json.dumps([q, [[f"{q} {i}", 0, [512]] for i in range(10)], {"k": 1}], ensure_ascii=False)
+        return Response(f"window.google.ac.h({body})", media_type="text/javascript")
+
+    async def edu_stream(request):
+        error = await behaviour.apply()
+        return error or JSONResponse({"url": f"https://www.youtube-nocookie.com/embed/{request.path_params['videoid']}"})
+
+    async def edu_key(request):
+        error = await behaviour.apply()
+        return error or JSONResponse({"key": "stub-key"})
+
+    return Starlette(routes=[
+        Route("/dl/{videoid}", dl),
+        Route("/vi/{videoid}/0.jpg", thumbnail),
+        Route("/complete/search", suggest),
+        Route("/api/stream/{videoid}", edu_stream),
+        Route("/media-api/youtube/key", edu_key),
+    ])
+
+
+async def serve(config):
+    servers = []
+    for spec in config.invidious:
+        if spec.get("dead") == "refuse":
+            continue  # ポートを確保したまま待ち受けない -> 接続拒否
+        servers.append(uvicorn.Server(uvicorn.Config(invidious_app(Behaviour(spec)), host=config.host, port=spec["port"], log_level="warning", lifespan="off")))
+    servers.append(uvicorn.Server(uvicorn.Config(media_app(Behaviour(config.media)), host=config.host, port=config.media["port"], log_level="warning", lifespan="off")))
+
+    tasks = [asyncio.ensure_future(server.serve()) for server in servers]
+    while not all(server.started for server in servers):
+        if any(task.done() for task in tasks):
+            raise RuntimeError("A stub server failed to start.")
+        await asyncio.sleep(0.05)
+    print("ready", flush=True)
+    await asyncio.gather(*tasks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--config", required=True, help="StubConfig 形式のJSONファイル")
+    args = parser.parse_args()
+    asyncio.run(serve(StubConfig.load(args.config)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""
+ベンチマーク対象のアプリを、上流の接続先をスタブに差し替えて起動する。
+
+    python -m bench.target --config stubs.json --port 8800
+
+--config は bench.stubs と同じ StubConfig 形式。起動後は通常の uvicorn と同じように待ち受ける。
+"""
+import argparse
+import os
+import tempfile
+
+import uvicorn
+
+from bench.stubs import StubConfig
+
+
+def configure(main, config):
+    """app.main の上流URLをスタブに向ける"""
+    base = f"http://{config.host}:{config.media['port']}"
+    instances = [f"http://{config.host}:{spec['port']}/" for spec in config.invidious]
+    main.invidious_api_data = {category: list(instances) for category in main.invidious_api_data}
+    main.invidious_api = main.InvidiousAPI()
+    main.YTDL_API_BASE_URL = f"{base}/dl/"
+    main.THUMBNAIL_URL = base + "/vi/{}/0.jpg"
+    main.SUGGEST_URL = f"{base}/complete/search?client=youtube&hl=ja&ds=yt&q="
+    main.EDU_STREAM_API_BASE_URL = f"{base}/api/stream/"
+    main.EDU_KEY_API_URL = f"{base}/media-api/youtube/key"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--config", required=True)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8800)
+    args = parser.parse_args()
+
+    # 前回の実行のサムネイルキャッシュを引き継がないようにする
+    os.environ.setdefault("THUMBNAIL_CACHE_DIR", tempfile.mkdtemp(prefix="yuzutube-bench-"))
+
+    import app.main as app_main
+    configure(app_main, StubConfig.load(args.config))
+    uvicorn.run(app_main.app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()